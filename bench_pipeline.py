@@ -0,0 +1,237 @@
+"""
+Benchmark for the process_folder image steps on a synthetic SKU corpus.
+
+Generates JPG/PNG "product shots" in the sizes and aspect ratios we get from
+the photographers, then times each step separately - letterbox resize,
+rembg, main webp encode, the reduced level, 500x500 PNG, 400x270 thumbnail
+and (for reference) the full-size thumbnail resample and the second rembg pass
+STEP 6 used to run - plus build_derivatives() end to
+end. Nothing is uploaded; STEP 7 is not part of the benchmark.
+
+Each step records wall time, CPU time and peak RSS. Results are written as
+JSON so two commits can be compared:
+
+    python bench_pipeline.py --out before.json
+    git checkout <other commit>
+    python bench_pipeline.py --out after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+from PIL import Image, ImageDraw, ImageFilter
+
+import image_pipeline
+from bg_removal import cutout, get_remover
+from encoding import PROFILES, encode
+from image_pipeline import MASTER_SIZE, PNG_SIZE, THUMB_SIZE, letterbox, on_white, reduce_factor
+from run_metrics import peak_rss_mb, reset_peak_rss
+
+# (width, height, format): camera originals, phone portrait, square and small web images.
+CORPUS_SHAPES = [
+    (6000, 4000, "JPEG"),
+    (4000, 6000, "JPEG"),
+    (4032, 3024, "JPEG"),
+    (3024, 4032, "PNG"),
+    (2000, 2000, "PNG"),
+    (1920, 1080, "JPEG"),
+    (800, 600, "PNG"),
+]
+
+
+# ----------------------------
+# Corpus
+# ----------------------------
+def make_product_shot(width, height, rng):
+    """Off-white studio background with a shaded 'part' and its shadow in the middle."""
+    image = Image.new("RGB", (width, height), tuple(rng.randint(225, 250) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    w, h = int(width * rng.uniform(0.35, 0.7)), int(height * rng.uniform(0.35, 0.7))
+    left, top = (width - w) // 2, (height - h) // 2
+    draw.ellipse((left + w // 10, top + h, left + w, top + h + h // 8), fill=(190, 190, 190))
+    color = tuple(rng.randint(20, 200) for _ in range(3))
+    if rng.random() < 0.5:
+        draw.rounded_rectangle((left, top, left + w, top + h), radius=min(w, h) // 6, fill=color)
+    else:
+        draw.ellipse((left, top, left + w, top + h), fill=color)
+    for _ in range(12):
+        x, y = rng.randint(left, left + w), rng.randint(top, top + h)
+        r = rng.randint(4, max(5, min(w, h) // 12))
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(min(255, c + 40) for c in color))
+    return image.filter(ImageFilter.GaussianBlur(radius=max(1, width // 1500)))
+
+
+def build_corpus(corpus_dir, per_shape, seed=7):
+    """Create (once) per_shape images of every CORPUS_SHAPES entry; returns their paths."""
+    rng = random.Random(seed)
+    os.makedirs(corpus_dir, exist_ok=True)
+    paths = []
+    for width, height, fmt in CORPUS_SHAPES:
+        for i in range(1, per_shape + 1):
+            ext = ".jpg" if fmt == "JPEG" else ".png"
+            path = os.path.join(corpus_dir, f"W{width}x{height}-{i:02d}{ext}")
+            if not os.path.exists(path):
+                make_product_shot(width, height, rng).save(path, format=fmt, quality=92)
+            paths.append(path)
+    return paths
+
+
+# ----------------------------
+# Measurement
+# ----------------------------
+class StepTimer:
+    def __init__(self):
+        self.samples = {}
+
+    def measure(self, step, fn, *args):
+        reset_peak_rss()
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = fn(*args)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        self.samples.setdefault(step, []).append({"wall": wall, "cpu": cpu, "peak_rss_mb": peak_rss_mb()})
+        return result
+
+    def summary(self):
+        steps = {}
+        for step, samples in self.samples.items():
+            walls = sorted(s["wall"] for s in samples)
+            steps[step] = {
+                "count": len(samples),
+                "wall_total": sum(walls),
+                "wall_mean": sum(walls) / len(walls),
+                "wall_p50": walls[len(walls) // 2],
+                "wall_max": walls[-1],
+                "cpu_total": sum(s["cpu"] for s in samples),
+                "peak_rss_mb": max(s["peak_rss_mb"] for s in samples),
+            }
+        return steps
+
+
+def run_steps(paths, timer):
+    remover = get_remover()
+    for path in paths:
+        def decode_letterbox():
+            with Image.open(path) as original:
+                return letterbox(original, MASTER_SIZE)
+
+        master = timer.measure("letterbox_6000x4000", decode_letterbox)
+        mask = timer.measure("rembg", remover.mask, master)
+        cut = timer.measure("cutout", cutout, master, mask)
+        timer.measure("webp_encode_main", encode, cut, PROFILES["main"])
+        def reduce_level():
+            factor = reduce_factor(master.size, (PNG_SIZE, THUMB_SIZE))
+            return master.reduce(factor), mask.reduce(factor)
+
+        small_master, small_mask = timer.measure("reduce_level", reduce_level)
+        timer.measure(
+            "png_500x500",
+            lambda: encode(letterbox(cutout(small_master, small_mask), PNG_SIZE), PROFILES["png"]),
+        )
+        thumb = timer.measure(
+            "thumb_400x270",
+            lambda: on_white(small_master.resize(THUMB_SIZE, Image.LANCZOS), small_mask.resize(THUMB_SIZE, Image.LANCZOS)),
+        )
+        # What STEP 4-6 used to resample from: the full 24 MP master, kept as a reference point.
+        timer.measure("thumb_400x270_from_master", lambda: master.resize(THUMB_SIZE, Image.LANCZOS))
+        timer.measure("webp_encode_thumb", encode, thumb, PROFILES["thumb"])
+        # The old STEP 6 re-ran rembg on the thumbnail; kept as a reference point.
+        timer.measure("rembg_thumb_legacy", remover.remove, cut.resize(THUMB_SIZE, Image.LANCZOS))
+
+
+def run_end_to_end(paths, timer):
+    """build_derivatives() over a scratch copy of the corpus, one SKU folder per shape."""
+    scratch = tempfile.mkdtemp(prefix="bench-")
+    try:
+        folders = {}
+        for path in paths:
+            sku = os.path.basename(path).split("-")[0]
+            folder_path = os.path.join(scratch, sku)
+            os.makedirs(folder_path, exist_ok=True)
+            shutil.copy(path, folder_path)
+            folders[sku] = folder_path
+        for sku, folder_path in folders.items():
+            timer.measure("build_derivatives_folder", image_pipeline.build_derivatives, folder_path, sku)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nvs {baseline_path} (commit {baseline.get('commit')}):")
+    print(f"{'step':<26} {'wall mean':>10} {'baseline':>10} {'change':>8} {'peak MB':>8} {'baseline':>9}")
+    for step, stats in current["steps"].items():
+        old = baseline["steps"].get(step)
+        if old is None:
+            print(f"{step:<26} {stats['wall_mean']:10.3f} {'-':>10} {'new':>8} {stats['peak_rss_mb']:8.0f} {'-':>9}")
+            continue
+        change = (stats["wall_mean"] - old["wall_mean"]) / old["wall_mean"] * 100 if old["wall_mean"] else 0.0
+        print(
+            f"{step:<26} {stats['wall_mean']:10.3f} {old['wall_mean']:10.3f} {change:+7.1f}% "
+            f"{stats['peak_rss_mb']:8.0f} {old['peak_rss_mb']:9.0f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the process_folder image steps on a synthetic SKU corpus.")
+    parser.add_argument("--corpus", default="bench_corpus", help="where the synthetic images are generated/cached")
+    parser.add_argument("--per-shape", type=int, default=2, help="images per size/aspect ratio")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--compare", metavar="JSON", help="earlier results to compare against")
+    parser.add_argument("--skip-end-to-end", action="store_true")
+    args = parser.parse_args()
+
+    paths = build_corpus(args.corpus, args.per_shape)
+    remover = get_remover()
+    with remover.session():
+        pass  # model load is reported separately, not billed to the first image
+
+    timer = StepTimer()
+    started = time.perf_counter()
+    run_steps(paths, timer)
+    if not args.skip_end_to_end:
+        run_end_to_end(paths, timer)
+
+    results = {
+        "commit": git_commit(),
+        "created": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "pillow": Image.__version__,
+        "cpu_count": os.cpu_count(),
+        "model": remover.label,
+        "segment_max_side": remover.segment_max_side,
+        "images": len(paths),
+        "model_load_seconds": remover.load_seconds,
+        "total_seconds": time.perf_counter() - started,
+        "steps": timer.summary(),
+    }
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"{'step':<26} {'n':>4} {'wall mean':>10} {'wall p50':>9} {'cpu total':>10} {'peak MB':>8}")
+    for step, stats in results["steps"].items():
+        print(
+            f"{step:<26} {stats['count']:>4} {stats['wall_mean']:10.3f} {stats['wall_p50']:9.3f} "
+            f"{stats['cpu_total']:10.2f} {stats['peak_rss_mb']:8.0f}"
+        )
+    print(f"Wrote {args.out}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,566 @@
+"""
+Shared rembg sessions for the weekly image scripts.
+
+Calling rembg.remove() without a session builds a brand new onnxruntime
+session (model load + graph initialization) on every call. The scripts call
+it twice per image, so a heavy week paid that setup cost hundreds of times.
+BackgroundRemover creates sessions once per run, hands them out from a small
+pool so concurrent workers each get their own, and keeps track of how long
+model loading took compared with the actual inference.
+
+The u2net family segments at about 320px whatever it is given, so masks are
+computed on a copy no larger than SEGMENT_MAX_SIDE and only the mask is scaled
+back up to the full image. Compare settings with:
+
+    python bg_removal.py --benchmark <folder of sample images> [--max-side 512 1024 0]
+
+The model (REMBG_MODEL, or an .onnx file such as a quantized export via
+REMBG_MODEL_PATH) and the onnxruntime thread counts / graph optimization level
+are configurable per run. With REMBG_MODEL_PATH, REMBG_MODEL still names the
+model family the file was exported from, which decides the session class and
+input normalisation (isnet-general-use, for one, runs at 1024x1024). Pick a
+model with:
+
+    python bg_removal.py --benchmark <folder> --models u2net u2netp silueta isnet-general-use
+    python bg_removal.py --quantize isnet-general-use --output models/isnet.quant.onnx
+    python bg_removal.py --benchmark <folder> --models isnet-general-use isnet-general-use=models/isnet.quant.onnx
+
+rembg (and with it onnxruntime, numpy and scipy) is only imported when the
+first session is built, so importing this module is cheap. Scripts that
+segment on worker threads must import rembg on the main thread first:
+imported from another thread, pymatting keeps the interpreter from exiting.
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from PIL import Image
+
+from run_metrics import metrics, timed_import
+
+DEFAULT_MODEL = os.environ.get("REMBG_MODEL", "u2net")
+# Optional .onnx file (e.g. a quantized export) loaded instead of the stock
+# weights of DEFAULT_MODEL's family.
+DEFAULT_MODEL_PATH = os.environ.get("REMBG_MODEL_PATH") or None
+# One session is enough for the serial scripts; raise it when folders are
+# processed by several workers at once.
+DEFAULT_POOL_SIZE = int(os.environ.get("REMBG_POOL_SIZE", "1"))
+# Longest side of the copy handed to the model. Larger keeps a little more edge
+# detail in the upscaled mask at the cost of pre/post-processing time; 0 segments
+# at full resolution (the old behaviour).
+DEFAULT_SEGMENT_MAX_SIDE = int(os.environ.get("SEGMENT_MAX_SIDE", "1024"))
+# Images per onnxruntime run when a folder is segmented in one go.
+DEFAULT_SEGMENT_BATCH_SIZE = int(os.environ.get("SEGMENT_BATCH_SIZE", "4"))
+
+# Largest mean |difference| (0-255) between a batched mask and session.predict()
+# for the same image before batching is turned off for that session.
+BATCH_MAX_MEAN_DIFF = 1.0
+
+# === onnxruntime tuning ===
+# 0 means automatic: all cores (onnxruntime's default) for a single session, or
+# the cores split between the sessions once the pool holds several (see
+# session_intra_op_threads), so concurrent folder workers don't oversubscribe the CPU.
+DEFAULT_INTRA_OP_THREADS = int(os.environ.get("ORT_INTRA_OP_THREADS", "0"))
+DEFAULT_INTER_OP_THREADS = int(os.environ.get("ORT_INTER_OP_THREADS", "0"))
+DEFAULT_GRAPH_OPTIMIZATION = os.environ.get("ORT_GRAPH_OPTIMIZATION", "all")
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": "ORT_DISABLE_ALL",
+    "basic": "ORT_ENABLE_BASIC",
+    "extended": "ORT_ENABLE_EXTENDED",
+    "all": "ORT_ENABLE_ALL",
+}
+
+
+def build_session(model_name, model_path=None, intra_op_threads=0, inter_op_threads=0, graph_optimization="all"):
+    """
+    Create a rembg session with explicit onnxruntime options. rembg's own
+    new_session() only honours OMP_NUM_THREADS, so the session class is
+    instantiated directly. model_path loads a custom/quantized .onnx file
+    exported from the model_name family, with that family's session class.
+    """
+    import onnxruntime as ort
+    from rembg.sessions import sessions_class
+
+    if graph_optimization not in GRAPH_OPTIMIZATION_LEVELS:
+        raise ValueError(f"Unknown graph optimization level '{graph_optimization}' (use {', '.join(GRAPH_OPTIMIZATION_LEVELS)})")
+
+    sess_opts = ort.SessionOptions()
+    if intra_op_threads:
+        sess_opts.intra_op_num_threads = intra_op_threads
+    if inter_op_threads:
+        sess_opts.inter_op_num_threads = inter_op_threads
+    sess_opts.graph_optimization_level = getattr(ort.GraphOptimizationLevel, GRAPH_OPTIMIZATION_LEVELS[graph_optimization])
+
+    kwargs = {}
+    if model_path and model_name == "u2net_custom":
+        kwargs["model_path"] = model_path
+    for session_class in sessions_class:
+        if session_class.name() == model_name:
+            if model_path and model_name != "u2net_custom":
+                session_class = _from_model_path(session_class, model_path)
+            return session_class(model_name, sess_opts, **kwargs)
+    raise ValueError(f"Unknown rembg model '{model_name}' (available: {', '.join(sc.name() for sc in sessions_class)})")
+
+
+def _from_model_path(session_class, model_path):
+    """session_class loading its weights from model_path instead of rembg's download cache."""
+
+    class PathSession(session_class):
+        @classmethod
+        def download_models(cls, *args, **kwargs):
+            return os.path.expanduser(model_path)
+
+    return PathSession
+
+
+class BackgroundRemover:
+    def __init__(
+        self,
+        model_name=DEFAULT_MODEL,
+        pool_size=DEFAULT_POOL_SIZE,
+        segment_max_side=DEFAULT_SEGMENT_MAX_SIDE,
+        batch_size=DEFAULT_SEGMENT_BATCH_SIZE,
+        model_path=DEFAULT_MODEL_PATH,
+        intra_op_threads=DEFAULT_INTRA_OP_THREADS,
+        inter_op_threads=DEFAULT_INTER_OP_THREADS,
+        graph_optimization=DEFAULT_GRAPH_OPTIMIZATION,
+    ):
+        self.model_name = model_name
+        self.pool_size = max(1, pool_size)
+        self.segment_max_side = segment_max_side
+        self.model_path = model_path
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.graph_optimization = graph_optimization
+        self.batch_size = max(1, batch_size)
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._created = 0
+        # id(session) -> (mean, std, size) once batching is verified, None when it is off.
+        self._batching = {}
+        self.load_seconds = 0.0
+        self.inference_seconds = 0.0
+        # Images segmented, and the remove()/masks() calls they came in (one batch each).
+        self.inference_count = 0
+        self.inference_batches = 0
+
+    def session_intra_op_threads(self):
+        """Intra-op threads each new session gets: the configured count, or the cores split across the pool."""
+        if self.intra_op_threads or self.pool_size == 1:
+            return self.intra_op_threads
+        return max(1, (os.cpu_count() or 1) // self.pool_size)
+
+    def _new_session(self):
+        timed_import("rembg", "rembg import")
+        start = time.perf_counter()
+        session = build_session(
+            self.model_name,
+            model_path=self.model_path,
+            intra_op_threads=self.session_intra_op_threads(),
+            inter_op_threads=self.inter_op_threads,
+            graph_optimization=self.graph_optimization,
+        )
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.load_seconds += elapsed
+        metrics.phase("model load", elapsed)
+        threads = self.session_intra_op_threads() or "all"
+        print(f"Loaded rembg model '{self.label}' in {elapsed:.2f}s ({threads} intra-op thread(s)).")
+        return session
+
+    @property
+    def label(self):
+        return f"{self.model_path} ({self.model_name})" if self.model_path else self.model_name
+
+    @contextmanager
+    def session(self):
+        """Borrow a session, creating one lazily while the pool has room."""
+        try:
+            session = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.pool_size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    session = self._new_session()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                session = self._idle.get()
+        try:
+            yield session
+        finally:
+            self._idle.put(session)
+
+    def _record_inference(self, elapsed, count=1):
+        with self._lock:
+            self.inference_seconds += elapsed
+            self.inference_count += count
+            self.inference_batches += 1
+
+    def remove(self, data, **kwargs):
+        """Same as rembg.remove(), but on a pooled session."""
+        import rembg
+
+        with self.session() as session:
+            start = time.perf_counter()
+            result = rembg.remove(data, session=session, **kwargs)
+            self._record_inference(time.perf_counter() - start)
+        return result
+
+    def mask(self, image, max_side=None):
+        """
+        Foreground mask (mode "L", same size as image). This is the mask
+        remove() cuts out with, so it can be kept and resized for smaller
+        derivatives instead of segmenting them again.
+
+        The model runs on a copy scaled down to max_side (default:
+        segment_max_side) and the resulting mask is upscaled to image.size.
+        """
+        return self.masks([image], max_side=max_side)[0]
+
+    def masks(self, images, max_side=None):
+        """
+        mask() for several images, stacked into a single onnxruntime run when
+        the model accepts a dynamic batch. Models with a fixed batch of 1, or
+        whose batched masks don't match predict(), are run one image at a time.
+        """
+        if max_side is None:
+            max_side = self.segment_max_side
+        smalls = [reduced_copy(image, max_side) for image in images]
+
+        with self.session() as session:
+            start = time.perf_counter()
+            predicted = None
+            if len(smalls) > 1 and self._batching.get(id(session), ()) is not None and supports_batching(session):
+                try:
+                    predicted = self._predict_batch(session, smalls)
+                except Exception as e:
+                    print(f"Batched segmentation failed ({e}); falling back to one image per run.")
+            if predicted is None:
+                predicted = [session.predict(small)[0] for small in smalls]
+            self._record_inference(time.perf_counter() - start, count=len(smalls))
+
+        for small, image in zip(smalls, images):
+            if small is not image:
+                small.close()
+        masks = []
+        for mask, image in zip(predicted, images):
+            if mask.size != image.size:
+                full = mask.resize(image.size, Image.LANCZOS)
+                mask.close()
+                mask = full
+            masks.append(mask)
+        return masks
+
+    def _predict_batch(self, session, smalls):
+        """
+        predict_batch() with the session's own normalisation. The first batch on
+        a session also runs predict() on its first image, capturing the
+        normalisation from it and checking the batched mask against it; on a
+        mismatch the session stays on one image per run from then on. Returns
+        None when the batch still has to be run image by image.
+        """
+        normalization = self._batching.get(id(session))
+        if normalization is not None:
+            return predict_batch(session, smalls, *normalization)
+
+        reference, normalization = predict_capturing_normalization(session, smalls[0])
+        predicted = None
+        if normalization is not None:
+            predicted = predict_batch(session, smalls, *normalization)
+            _, diff = mask_agreement(reference, predicted[0])
+            if diff > BATCH_MAX_MEAN_DIFF:
+                print(f"Batched masks differ from predict() for '{self.label}' (mean |diff| {diff:.2f}); segmenting one image per run.")
+                normalization = predicted = None
+        else:
+            print(f"Can't read the input normalisation of '{self.label}'; segmenting one image per run.")
+        with self._lock:
+            self._batching[id(session)] = normalization
+        if predicted is None:
+            return [reference] + [session.predict(small)[0] for small in smalls[1:]]
+        predicted[0].close()
+        predicted[0] = reference
+        return predicted
+
+    def summary(self):
+        if not self._created:
+            return "rembg: model never loaded (no images processed)."
+        average = self.inference_seconds / self.inference_count if self.inference_count else 0.0
+        return (
+            f"rembg: model '{self.label}' loaded {self._created}x in {self.load_seconds:.2f}s total; "
+            f"inference {self.inference_seconds:.2f}s over {self.inference_count} image(s) "
+            f"in {self.inference_batches} batch(es) ({average:.2f}s avg per image)."
+        )
+
+
+def supports_batching(session):
+    batch_dim = session.inner_session.get_inputs()[0].shape[0]
+    return not isinstance(batch_dim, int) or batch_dim < 1
+
+
+def predict_capturing_normalization(session, image):
+    """
+    (session.predict(image)[0], the (mean, std, size) predict() normalised
+    with), or None for the latter when predict() didn't normalise exactly once.
+    """
+    calls = []
+    normalize = session.normalize
+
+    def capture(img, mean, std, size, *args, **kwargs):
+        calls.append((mean, std, size))
+        return normalize(img, mean, std, size, *args, **kwargs)
+
+    session.normalize = capture
+    try:
+        mask = session.predict(image)[0]
+    finally:
+        del session.normalize
+    return mask, calls[0] if len(calls) == 1 else None
+
+
+def predict_batch(session, images, mean, std, size):
+    """
+    session.predict() for a list of images in one run. Each prediction is
+    min/max normalised on its own, as predict() does, so the masks are the
+    same as running the images one by one.
+    """
+    import numpy as np
+
+    input_name = session.inner_session.get_inputs()[0].name
+    batch = np.concatenate([session.normalize(image, mean, std, size)[input_name] for image in images])
+    predictions = session.inner_session.run(None, {input_name: batch})[0][:, 0, :, :]
+
+    masks = []
+    for pred, image in zip(predictions, images):
+        ma, mi = np.max(pred), np.min(pred)
+        pred = (pred - mi) / (ma - mi)
+        mask = Image.fromarray((pred * 255).astype("uint8"), mode="L")
+        masks.append(mask.resize(image.size, Image.LANCZOS))
+        mask.close()
+    return masks
+
+
+def reduced_copy(image, max_side):
+    """image scaled so its longest side is at most max_side (image itself if already small or max_side is 0)."""
+    if not max_side or max(image.size) <= max_side:
+        return image
+    scale = max_side / max(image.size)
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+
+
+def cutout(image, mask):
+    """Transparent cutout of image through mask, identical to remove()'s default output."""
+    from rembg.bg import naive_cutout
+
+    return naive_cutout(image, mask)
+
+
+_default_remover = None
+_default_lock = threading.Lock()
+
+
+def get_remover():
+    """Process-wide remover shared by every folder and every STEP."""
+    global _default_remover
+    with _default_lock:
+        if _default_remover is None:
+            _default_remover = BackgroundRemover()
+        return _default_remover
+
+
+# ----------------------------
+# Benchmark
+# ----------------------------
+def mask_agreement(reference, candidate):
+    """(IoU of the thresholded masks, mean absolute difference in 0-255 units)."""
+    import numpy as np
+
+    ref = np.asarray(reference, dtype=np.int16)
+    cand = np.asarray(candidate, dtype=np.int16)
+    ref_fg, cand_fg = ref >= 128, cand >= 128
+    union = np.logical_or(ref_fg, cand_fg).sum()
+    iou = np.logical_and(ref_fg, cand_fg).sum() / union if union else 1.0
+    return float(iou), float(np.abs(ref - cand).mean())
+
+
+def benchmark_segmentation(paths, max_sides, out_dir=None):
+    """
+    Segment every image at full resolution (the current output) and at each
+    max_side, printing time per image and agreement with the full-resolution
+    mask. With out_dir, writes current|reduced side-by-side previews on white.
+    """
+    from image_pipeline import MASTER_SIZE, letterbox, on_white
+
+    remover = BackgroundRemover(pool_size=1)
+    with remover.session():
+        pass  # load the model up front so it is not billed to the first setting
+
+    masters = []
+    for path in paths:
+        with Image.open(path) as original:
+            masters.append((os.path.basename(path), letterbox(original, MASTER_SIZE)))
+
+    def run(max_side):
+        start = time.perf_counter()
+        masks = [remover.mask(master, max_side=max_side) for _, master in masters]
+        return masks, (time.perf_counter() - start) / len(masters)
+
+    reference, reference_seconds = run(0)
+    print(f"{'max side':>9} {'s/image':>8} {'speedup':>8} {'IoU':>7} {'mean |diff|':>12}")
+    print(f"{'full':>9} {reference_seconds:8.2f} {1.0:8.2f} {1.0:7.4f} {0.0:12.2f}")
+
+    # Batched vs one-at-a-time at the production setting; should agree exactly.
+    start = time.perf_counter()
+    batched = []
+    for i in range(0, len(masters), remover.batch_size):
+        batched.extend(remover.masks([master for _, master in masters[i:i + remover.batch_size]]))
+    batched_seconds = (time.perf_counter() - start) / len(masters)
+    single, single_seconds = run(remover.segment_max_side)
+    scores = [mask_agreement(ref, cand) for ref, cand in zip(single, batched)]
+    print(
+        f"{'batch ' + str(remover.batch_size):>9} {batched_seconds:8.2f} {single_seconds / batched_seconds:8.2f} "
+        f"{sum(s[0] for s in scores) / len(scores):7.4f} {sum(s[1] for s in scores) / len(scores):12.2f}"
+        f"  (vs single-image at max side {remover.segment_max_side})"
+    )
+    for max_side in max_sides:
+        if not max_side:
+            continue
+        masks, seconds = run(max_side)
+        scores = [mask_agreement(ref, cand) for ref, cand in zip(reference, masks)]
+        iou = sum(s[0] for s in scores) / len(scores)
+        diff = sum(s[1] for s in scores) / len(scores)
+        print(f"{max_side:>9} {seconds:8.2f} {reference_seconds / seconds:8.2f} {iou:7.4f} {diff:12.2f}")
+
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+            for (name, master), ref, cand in zip(masters, reference, masks):
+                preview = Image.new('RGB', (master.width * 2, master.height), (255, 255, 255))
+                preview.paste(on_white(master, ref), (0, 0))
+                preview.paste(on_white(master, cand), (master.width, 0))
+                preview.thumbnail((2400, 800))
+                preview.save(os.path.join(out_dir, f"{os.path.splitext(name)[0]}-{max_side}.jpg"), quality=90)
+
+
+def _candidate_remover(candidate, **options):
+    """candidate: a stock model name, FAMILY=path.onnx, or path.onnx (of the REMBG_MODEL family)."""
+    if candidate.endswith(".onnx"):
+        family, _, path = candidate.rpartition("=")
+        return BackgroundRemover(model_name=family or DEFAULT_MODEL, model_path=path, pool_size=1, **options)
+    return BackgroundRemover(model_name=candidate, pool_size=1, **options)
+
+
+def _run_model_candidate(candidate, paths, options):
+    """Runs in a fresh process so peak RSS belongs to this candidate alone."""
+    import resource
+
+    from image_pipeline import MASTER_SIZE, letterbox
+
+    remover = _candidate_remover(candidate, **options)
+    with remover.session():
+        pass
+
+    masks = []
+    inference_seconds = 0.0
+    for path in paths:
+        with Image.open(path) as original:
+            master = letterbox(original, MASTER_SIZE)
+        start = time.perf_counter()
+        mask = remover.mask(master)
+        inference_seconds += time.perf_counter() - start
+        masks.append(reduced_copy(mask, 1024))
+    return {
+        "load_seconds": remover.load_seconds,
+        "images_per_second": len(paths) / inference_seconds if inference_seconds else 0.0,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "masks": masks,
+    }
+
+
+def benchmark_models(paths, candidates, options):
+    """
+    Run each candidate model (stock name or [FAMILY=].onnx path) over the sample and
+    report images/s, model load time, peak RSS and mask agreement with the
+    first candidate, which should be the model currently in production.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for candidate in candidates:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results.append((candidate, pool.submit(_run_model_candidate, candidate, paths, options).result()))
+
+    _, reference = results[0]
+    print(f"{'model':<32} {'img/s':>7} {'load s':>7} {'peak MB':>8} {'IoU':>7} {'mean |diff|':>12}")
+    for candidate, result in results:
+        scores = [mask_agreement(ref, cand) for ref, cand in zip(reference["masks"], result["masks"])]
+        iou = sum(s[0] for s in scores) / len(scores)
+        diff = sum(s[1] for s in scores) / len(scores)
+        print(
+            f"{candidate:<32} {result['images_per_second']:7.2f} {result['load_seconds']:7.2f} "
+            f"{result['peak_rss_mb']:8.0f} {iou:7.4f} {diff:12.2f}"
+        )
+
+
+def quantize_model(model_name, output_path):
+    """Write a dynamically quantized (uint8 weights) copy of a stock rembg model."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from rembg.sessions import sessions_class
+
+    for session_class in sessions_class:
+        if session_class.name() == model_name:
+            source = session_class.download_models()
+            break
+    else:
+        raise SystemExit(f"Unknown rembg model '{model_name}'")
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    quantize_dynamic(source, output_path, weight_type=QuantType.QUInt8)
+    print(f"Quantized {source} -> {output_path} ({os.path.getsize(source) >> 20} MB -> {os.path.getsize(output_path) >> 20} MB)")
+    print(f"Use it with REMBG_MODEL={model_name} REMBG_MODEL_PATH={output_path}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark segmentation settings and models on sample SKU photos.")
+    parser.add_argument("--benchmark", metavar="DIR", help="folder of sample SKU photos (.jpg/.png)")
+    parser.add_argument("--max-side", type=int, nargs="+", default=[320, 512, 1024, 2048])
+    parser.add_argument("--out", metavar="DIR", help="write side-by-side previews here")
+    parser.add_argument("--models", nargs="+", metavar="MODEL", help="compare these models / [FAMILY=].onnx files instead (first one is the reference)")
+    parser.add_argument("--intra-op", type=int, default=DEFAULT_INTRA_OP_THREADS)
+    parser.add_argument("--inter-op", type=int, default=DEFAULT_INTER_OP_THREADS)
+    parser.add_argument("--graph-opt", choices=sorted(GRAPH_OPTIMIZATION_LEVELS), default=DEFAULT_GRAPH_OPTIMIZATION)
+    parser.add_argument("--quantize", metavar="MODEL", help="write a quantized copy of MODEL to --output and exit")
+    parser.add_argument("--output", metavar="PATH")
+    args = parser.parse_args()
+
+    if args.quantize:
+        if not args.output:
+            parser.error("--quantize needs --output")
+        quantize_model(args.quantize, args.output)
+        raise SystemExit(0)
+    if not args.benchmark:
+        parser.error("--benchmark DIR is required")
+
+    samples = sorted(
+        os.path.join(args.benchmark, f) for f in os.listdir(args.benchmark)
+        if f.lower().endswith((".jpg", ".jpeg", ".png"))
+    )
+    if not samples:
+        raise SystemExit(f"No .jpg/.png images in {args.benchmark}")
+    if args.models:
+        benchmark_models(samples, args.models, {
+            "intra_op_threads": args.intra_op,
+            "inter_op_threads": args.inter_op,
+            "graph_optimization": args.graph_opt,
+        })
+    else:
+        benchmark_segmentation(samples, args.max_side, args.out)
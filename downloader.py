@@ -0,0 +1,129 @@
+"""
+Concurrent, streaming downloads of files behind the Dropbox shared link.
+
+The old loop fetched one file at a time and buffered each multi-megabyte JPEG
+in memory through res.content. Downloader runs up to DOWNLOAD_WORKERS
+transfers at once (shared by all folder workers, so the total stays bounded),
+streams each body to a .part file in chunks, retries rate limits (429) and
+server errors (5xx, dropped connections) with exponential backoff, and keeps
+byte/time totals for a throughput line in the report.
+
+Left to itself the Dropbox SDK retries a 429 forever and a 5xx four times,
+sleeping inside the call. Downloader therefore works on a copy of the client
+with those retries turned off (see without_sdk_retries), so retry_delay() is
+the only retry policy and a RateLimitError actually reaches it.
+"""
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+import dropbox
+import requests
+
+from run_metrics import metrics
+
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "4"))
+MAX_ATTEMPTS = int(os.environ.get("DOWNLOAD_MAX_ATTEMPTS", "5"))
+CHUNK_SIZE = 1024 * 1024
+
+
+def without_sdk_retries(dbx):
+    """Copy of dbx whose SDK raises rate limits and server errors instead of retrying them itself."""
+    return dbx.clone(max_retries_on_rate_limit=0, max_retries_on_error=0)
+
+
+def retry_delay(error, attempt):
+    """Seconds to wait before retrying error, or None if it is not worth retrying."""
+    if isinstance(error, dropbox.exceptions.RateLimitError):
+        return error.backoff or min(60, 2 ** attempt)
+    if isinstance(error, dropbox.exceptions.InternalServerError):
+        return min(60, 2 ** attempt) + random.random()
+    if isinstance(error, dropbox.exceptions.HttpError) and (error.status_code == 429 or error.status_code >= 500):
+        return min(60, 2 ** attempt) + random.random()
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout)):
+        return min(60, 2 ** attempt) + random.random()
+    return None
+
+
+class Downloader:
+    def __init__(self, dbx, shared_link, workers=DOWNLOAD_WORKERS):
+        self.dbx = without_sdk_retries(dbx)
+        self.shared_link = shared_link
+        self.workers = max(1, workers)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="download")
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.total_files = 0
+        self.busy_seconds = 0.0
+        self._first_start = None
+        self._last_end = None
+
+    def _fetch(self, dropbox_path, local_path):
+        tmp_path = local_path + ".part"
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                md, res = self.dbx.sharing_get_shared_link_file(url=self.shared_link, path=dropbox_path)
+                size = 0
+                with closing(res), open(tmp_path, "wb") as out_f:
+                    for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                        out_f.write(chunk)
+                        size += len(chunk)
+                os.replace(tmp_path, local_path)
+                return size, attempt
+            except Exception as e:
+                delay = retry_delay(e, attempt)
+                if delay is None or attempt == MAX_ATTEMPTS:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+                time.sleep(delay)
+
+    def _download_one(self, dropbox_path, local_path):
+        start = time.perf_counter()
+        with self._lock:
+            if self._first_start is None:
+                self._first_start = start
+        try:
+            size, attempts = self._fetch(dropbox_path, local_path)
+            error = None
+        except Exception as e:
+            size, attempts, error = 0, MAX_ATTEMPTS, e
+        end = time.perf_counter()
+        with self._lock:
+            self._last_end = end
+            self.busy_seconds += end - start
+            if error is None:
+                self.total_bytes += size
+                self.total_files += 1
+        metrics.event(
+            "download", duration=end - start, status="ok" if error is None else "error",
+            path=dropbox_path, bytes_in=size, attempts=attempts, error=str(error) if error else None,
+        )
+        return dropbox_path, local_path, size, end - start, attempts, error
+
+    def download(self, jobs):
+        """
+        jobs: list of (dropbox_path, local_path). Returns one
+        (dropbox_path, local_path, bytes, seconds, attempts, error) per job,
+        in order; error is None on success. Nothing is printed here so the
+        caller's (folder worker's) log stays together.
+        """
+        futures = [self._pool.submit(self._download_one, dropbox_path, local_path) for dropbox_path, local_path in jobs]
+        return [future.result() for future in futures]
+
+    def summary(self):
+        if not self.total_files:
+            return "Downloads: none."
+        wall = (self._last_end - self._first_start) if self._first_start is not None else 0.0
+        mb = self.total_bytes / (1024 * 1024)
+        rate = mb / wall if wall else 0.0
+        return (
+            f"Downloads: {self.total_files} file(s), {mb:.1f} MB in {wall:.1f}s wall "
+            f"({rate:.2f} MB/s, {self.busy_seconds:.1f}s of transfer time over {self.workers} worker(s))."
+        )
+
+    def close(self):
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,345 @@
+"""
+Persistent listing of the shared-link folder tree.
+
+Every weekly run used to list the shared-link root and then every SKU folder
+in it (~1,150 files_list_folder calls) even when nothing had changed. The
+listing is now kept in .list_state.json together with the Dropbox cursors that
+produced it, so the next run only asks Dropbox for what changed since.
+
+Two modes, picked on the first (full) listing:
+
+* path:        the shared link resolves to a folder in this account, so one
+               recursive cursor covers the whole tree and an unchanged week
+               costs a single files_list_folder_continue call.
+* shared_link: the folder is only reachable through the link. Dropbox does
+               not allow recursive listing of shared links, so each SKU folder
+               keeps its own cursor; unchanged folders come back empty. The
+               per-folder calls run LISTING_WORKERS at a time.
+
+Every call is retried on rate limits and server errors. A 429 pauses all
+workers for the Retry-After Dropbox sends (RateLimitError.backoff), not just
+the one that hit it. The calls go through a client with the SDK's own retries
+turned off (see downloader.without_sdk_retries), which would otherwise sleep
+out each 429 inside the worker that hit it.
+
+refresh() returns the set of top-level folder names whose contents changed,
+or None after a full listing (everything should be considered).
+
+The cursors move past every change as soon as it is listed, whether or not the
+folder then gets through the run. The caller records the folders that failed
+in failed, which is saved with the cursors, so the next run can retry them.
+"""
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import dropbox
+from dropbox.files import DeletedMetadata, FileMetadata, FolderMetadata, SharedLink
+
+from downloader import retry_delay, without_sdk_retries
+
+LISTING_WORKERS = int(os.environ.get("LISTING_WORKERS", "8"))
+LISTING_MAX_ATTEMPTS = int(os.environ.get("LISTING_MAX_ATTEMPTS", "6"))
+
+IndexedFile = namedtuple("IndexedFile", "name server_modified client_modified content_hash size")
+IndexedFolder = namedtuple("IndexedFolder", "name files")
+
+
+def _file_to_json(f):
+    return {
+        "name": f.name,
+        "server_modified": f.server_modified.isoformat() if f.server_modified else None,
+        "client_modified": f.client_modified.isoformat() if f.client_modified else None,
+        "content_hash": f.content_hash,
+        "size": f.size,
+    }
+
+
+def _file_from_json(data):
+    return IndexedFile(
+        name=data["name"],
+        server_modified=datetime.fromisoformat(data["server_modified"]) if data["server_modified"] else None,
+        client_modified=datetime.fromisoformat(data["client_modified"]) if data["client_modified"] else None,
+        content_hash=data["content_hash"],
+        size=data["size"],
+    )
+
+
+def _indexed(entry):
+    return IndexedFile(
+        name=entry.name,
+        server_modified=entry.server_modified,
+        client_modified=entry.client_modified,
+        content_hash=entry.content_hash,
+        size=entry.size,
+    )
+
+
+def _is_reset(error):
+    """True when Dropbox says a saved cursor is no longer valid."""
+    return getattr(error.error, "is_reset", lambda: False)()
+
+
+class FolderListing:
+    def __init__(self, path, shared_link):
+        self.path = path
+        self.shared_link = shared_link
+        self.mode = None
+        self.root_path = None
+        self.cursor = None
+        # folder name -> {"cursor": str or None, "files": {file name: IndexedFile}}
+        self.folders = {}
+        # lower-cased folder name -> its key in folders (deletes only carry lower-case paths)
+        self._keys = {}
+        # Folders the last run failed on, to retry next run (set by the caller, saved with the cursors).
+        self.failed = set()
+        self.workers = max(1, LISTING_WORKERS)
+        self.api_calls = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    @classmethod
+    def load(cls, path, shared_link):
+        listing = cls(path, shared_link)
+        if not os.path.exists(path):
+            return listing
+        with open(path, "r") as f:
+            state = json.load(f)
+        if state.get("shared_link") != shared_link:
+            print(f"{path} was written for a different shared link; starting a fresh listing.")
+            return listing
+        listing.mode = state["mode"]
+        listing.root_path = state.get("root_path")
+        listing.cursor = state["cursor"]
+        listing.folders = {
+            name: {
+                "cursor": folder.get("cursor"),
+                "files": {f["name"]: _file_from_json(f) for f in folder["files"]},
+            }
+            for name, folder in state["folders"].items()
+        }
+        listing._keys = {name.lower(): name for name in listing.folders}
+        listing.failed = set(state.get("failed", []))
+        return listing
+
+    def save(self):
+        state = {
+            "shared_link": self.shared_link,
+            "mode": self.mode,
+            "root_path": self.root_path,
+            "cursor": self.cursor,
+            "folders": {
+                name: {
+                    "cursor": folder["cursor"],
+                    "files": [_file_to_json(f) for f in folder["files"].values()],
+                }
+                for name, folder in self.folders.items()
+            },
+            "failed": sorted(self.failed),
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def folder(self, name):
+        return IndexedFolder(name, list(self.folders[name]["files"].values()))
+
+    def refresh(self, dbx):
+        start = time.perf_counter()
+        dbx = without_sdk_retries(dbx)
+        self.api_calls = 0
+        self.rate_limited = 0
+        changed = None
+        if self.cursor is not None:
+            try:
+                changed = self._incremental(dbx)
+            except dropbox.exceptions.ApiError as e:
+                if not _is_reset(e):
+                    raise
+                print("Saved Dropbox cursor was reset; relisting everything.")
+                failed = self.failed
+                self.__init__(self.path, self.shared_link)
+                self.failed = failed
+        if self.cursor is None:
+            self._full(dbx)
+
+        summary = "full listing" if changed is None else f"{len(changed)} changed folder(s)"
+        throttled = f", rate-limited {self.rate_limited}x" if self.rate_limited else ""
+        print(
+            f"Listed {len(self.folders)} folder(s) in {time.perf_counter() - start:.1f}s "
+            f"with {self.api_calls} API call(s) over {self.workers} worker(s) ({self.mode} mode, {summary}{throttled})."
+        )
+        return changed
+
+    # ----------------------------
+    # Dropbox calls
+    # ----------------------------
+    def _call(self, method, *args, **kwargs):
+        """One API call, retried on rate limits (honouring Retry-After for every worker) and server errors."""
+        for attempt in range(1, LISTING_MAX_ATTEMPTS + 1):
+            with self._lock:
+                wait = self._resume_at - time.monotonic()
+                self.api_calls += 1
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                return method(*args, **kwargs)
+            except Exception as e:
+                delay = retry_delay(e, attempt)
+                if delay is None or attempt == LISTING_MAX_ATTEMPTS:
+                    raise
+                if isinstance(e, dropbox.exceptions.RateLimitError):
+                    with self._lock:
+                        self.rate_limited += 1
+                        self._resume_at = max(self._resume_at, time.monotonic() + delay)
+                else:
+                    time.sleep(delay)
+
+    def _list(self, dbx, path, **kwargs):
+        """All entries under path plus the cursor to continue from next run."""
+        result = self._call(dbx.files_list_folder, path=path, **kwargs)
+        entries = list(result.entries)
+        while result.has_more:
+            result = self._call(dbx.files_list_folder_continue, result.cursor)
+            entries.extend(result.entries)
+        return entries, result.cursor
+
+    def _continue(self, dbx, cursor):
+        entries = []
+        while True:
+            result = self._call(dbx.files_list_folder_continue, cursor)
+            entries.extend(result.entries)
+            cursor = result.cursor
+            if not result.has_more:
+                return entries, cursor
+
+    def _resolve_root(self, dbx):
+        """Path of the linked folder in this account, or None if it is not mounted here."""
+        try:
+            metadata = self._call(dbx.sharing_get_shared_link_metadata, self.shared_link)
+        except dropbox.exceptions.ApiError:
+            return None
+        return getattr(metadata, "path_lower", None)
+
+    def _link(self):
+        return SharedLink(url=self.shared_link)
+
+    # ----------------------------
+    # Full and incremental listing
+    # ----------------------------
+    def _full(self, dbx):
+        self.folders = {}
+        self._keys = {}
+        self.root_path = self._resolve_root(dbx)
+        if self.root_path:
+            self.mode = "path"
+            entries, self.cursor = self._list(dbx, self.root_path, recursive=True)
+            self._apply_recursive(entries, set())
+            return
+
+        self.mode = "shared_link"
+        entries, self.cursor = self._list(dbx, "", shared_link=self._link())
+        self._list_folders(dbx, [entry.name for entry in entries if isinstance(entry, FolderMetadata)])
+
+    def _incremental(self, dbx):
+        changed = set()
+        entries, cursor = self._continue(dbx, self.cursor)
+        if self.mode == "path":
+            self._apply_recursive(entries, changed)
+            self.cursor = cursor
+            return changed
+
+        for entry in entries:
+            if isinstance(entry, FolderMetadata):
+                self._add_folder(entry.name)
+            elif isinstance(entry, DeletedMetadata):
+                self._drop_folder(entry.name)
+        self.cursor = cursor
+        return self._list_folders(dbx, list(self.folders))
+
+    def _fetch_folder(self, dbx, name, cursor):
+        """
+        Continue one folder from cursor, or list it from scratch when it has none
+        (or Dropbox reset it). Returns (name, entries, cursor, relisted); runs on
+        a worker thread, so it only talks to Dropbox.
+        """
+        if cursor is not None:
+            try:
+                entries, cursor = self._continue(dbx, cursor)
+                return name, entries, cursor, False
+            except dropbox.exceptions.ApiError as e:
+                if not _is_reset(e):
+                    raise
+        entries, cursor = self._list(dbx, "/" + name, shared_link=self._link())
+        return name, entries, cursor, True
+
+    def _list_folders(self, dbx, names):
+        """Bring the named SKU folders up to date concurrently; returns the names whose files changed."""
+        changed = set()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="listing") as pool:
+            futures = [
+                pool.submit(self._fetch_folder, dbx, name, self.folders.get(name, {}).get("cursor"))
+                for name in names
+            ]
+            for future in futures:
+                name, entries, cursor, relisted = future.result()
+                if relisted:
+                    folder = self.folders[name] = {"cursor": cursor, "files": {}}
+                else:
+                    folder = self.folders[name]
+                    folder["cursor"] = cursor
+                if self._apply_folder_entries(folder, entries) or relisted:
+                    changed.add(name)
+        return changed
+
+    def _apply_folder_entries(self, folder, entries):
+        """Apply one folder's (non-recursive) entries; True if any file changed."""
+        touched = False
+        for entry in entries:
+            if isinstance(entry, FileMetadata):
+                folder["files"][entry.name] = _indexed(entry)
+                touched = True
+            elif isinstance(entry, DeletedMetadata):
+                for file_name in [n for n in folder["files"] if n.lower() == entry.name.lower()]:
+                    del folder["files"][file_name]
+                    touched = True
+        return touched
+
+    def _apply_recursive(self, entries, changed):
+        """Apply entries from a recursive listing of root_path: <folder> and <folder>/<file> only."""
+        depth = len(self.root_path.strip("/").split("/"))
+        for entry in entries:
+            path = entry.path_display or entry.path_lower
+            parts = path.strip("/").split("/")[depth:]
+            if not parts or len(parts) > 2:
+                continue
+
+            if len(parts) == 1:
+                if isinstance(entry, FolderMetadata):
+                    self._add_folder(parts[0])
+                    changed.add(self._folder_key(parts[0]))
+                elif isinstance(entry, DeletedMetadata):
+                    self._drop_folder(parts[0])
+                continue
+
+            folder = self._add_folder(parts[0])
+            if self._apply_folder_entries(folder, [entry]):
+                changed.add(self._folder_key(parts[0]))
+
+    def _folder_key(self, name):
+        """Existing folder key matching name case-insensitively (deletes only carry lower-case paths)."""
+        return self._keys.get(name.lower(), name)
+
+    def _add_folder(self, name):
+        """The folder entry for name, created empty if the listing does not have it yet."""
+        key = self._keys.setdefault(name.lower(), name)
+        return self.folders.setdefault(key, {"cursor": None, "files": {}})
+
+    def _drop_folder(self, name):
+        self.folders.pop(self._keys.pop(name.lower(), name), None)
@@ -0,0 +1,262 @@
+"""
+Encoding profiles for the published derivatives.
+
+Encode settings used to be hard-coded per script and disagreed: the main webp
+was quality=10 in shared-link-v2.py and 80 everywhere else, the PNG passed a
+quality (which PNG ignores) and the thumbnails used Pillow's defaults. Each
+derivative now has one profile with a byte budget, and encode() picks the best
+setting that fits:
+
+    WEBP  highest quality in [min_quality, max_quality] under max_bytes
+          (max_quality first, then a binary search), at the profile's method
+    PNG   optimized truecolour, or a 256-colour palette if that is over budget
+
+A plain binary search on the 24 MP main image always costs seven or eight
+full-size encodes. Above SEARCH_MAX_PIXELS, a first estimate comes from
+searching an Image.reduce() copy against the budget scaled by area. A reduced
+copy packs more detail into each pixel, so it compresses worse per pixel and
+the estimate is usually too low, sometimes far too low. The full image is
+encoded at the estimate; if that lands well under budget, max_quality is
+tried next, which settles images that fit at the top of the range in two
+encodes. From there each further full-size encode is chosen from what is
+known so far:
+
+* while every encode fits (or none does), the reduced copy is searched again
+  against the budget divided by the full/reduced size ratio just measured;
+* once there is an encode on each side of the budget, false position
+  (regula falsi) with the Illinois correction picks the next quality, kept
+  within the middle half of the bracket, and a plain bisection step is taken
+  whenever the last step shrank the bracket by less than half.
+
+The search stops when no quality is left between the best fit and the lowest
+miss, or after SEARCH_FULL_ENCODES full-size encodes; the reduced-copy
+searches add about one more.
+
+An image that cannot fit even at the lowest setting is written at that
+setting and reported as over budget. Budgets can be changed per run with
+<NAME>_MAX_KB, e.g. MAIN_MAX_KB=500.
+
+Encoding used to run on the thread that segments the next image. submit()
+hands an encode to a shared pool of ENCODE_WORKERS threads instead: Pillow
+releases the GIL while it encodes, so the WebP searches and PNG passes of
+every derivative run side by side on all cores. save() writes through a
+temporary file and renames it into place, so a derivative on disk is always
+complete, even if the run dies mid-write.
+"""
+import io
+import math
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", str(os.cpu_count() or 1)))
+# Images larger than this have their WEBP quality searched on a reduced copy.
+SEARCH_MAX_PIXELS = int(os.environ.get("ENCODE_SEARCH_MAX_PIXELS", str(1500 * 1000)))
+# Full-size encodes allowed per image when searching from the reduced-copy estimate.
+SEARCH_FULL_ENCODES = int(os.environ.get("ENCODE_SEARCH_FULL_ENCODES", "8"))
+# A full-size encode at most this share of the budget is "well under" it: max_quality is tried next.
+SEARCH_HEADROOM = 0.5
+
+EncodingProfile = namedtuple("EncodingProfile", "name format max_bytes min_quality max_quality method")
+
+
+def _profile(name, format, max_kb, min_quality=None, max_quality=None, method=None):
+    max_kb = int(os.environ.get(f"{name.upper()}_MAX_KB", str(max_kb)))
+    return EncodingProfile(name, format, max_kb * 1024, min_quality, max_quality, method)
+
+
+PROFILES = {
+    # <stem>.webp, 6000x4000 cutout. The old scripts' 80 is the ceiling and v2's 10 the floor;
+    # method 4 because the final encode (and any correction) is at the full 24 MP.
+    "main": _profile("main", "WEBP", 350, min_quality=10, max_quality=80, method=4),
+    # images/<stem>.webp, 400x270 on white.
+    "thumb": _profile("thumb", "WEBP", 25, min_quality=40, max_quality=85, method=6),
+    # PNG/<folder>.png, 500x500.
+    "png": _profile("png", "PNG", 150),
+}
+
+
+def _encode_webp(image, profile, quality):
+    buffer = io.BytesIO()
+    image.save(buffer, format="WEBP", quality=quality, method=profile.method)
+    return buffer.getvalue()
+
+
+def _encode_png(image, palette):
+    buffer = io.BytesIO()
+    if palette:
+        quantized = image.quantize(colors=256)
+        quantized.save(buffer, format="PNG", optimize=True)
+        quantized.close()
+    else:
+        image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def _bisect_webp(image, profile, max_bytes, low, high, limit=None):
+    """
+    Highest quality in [low, high] whose encode fits max_bytes, using at most
+    limit encodes. Returns (best, lowest): the (data, quality) that fit best,
+    or None, and the (data, quality) of the lowest quality tried, or None.
+    """
+    best = lowest = None
+    attempts = 0
+    while low <= high and (limit is None or attempts < limit):
+        quality = (low + high) // 2
+        data = _encode_webp(image, profile, quality)
+        attempts += 1
+        if len(data) <= max_bytes:
+            best = (data, quality)
+            low = quality + 1
+        else:
+            if lowest is None or quality < lowest[1]:
+                lowest = (data, quality)
+            high = quality - 1
+    return best, lowest
+
+
+def _at_min_quality(image, profile, lowest):
+    """The encode at min_quality, reused from lowest (see _bisect_webp) when that is what it was."""
+    if lowest is not None and lowest[1] == profile.min_quality:
+        return lowest[0]
+    return _encode_webp(image, profile, profile.min_quality)
+
+
+def _search_webp(image, profile, max_bytes):
+    """Highest quality in the profile's range that fits max_bytes: (data, quality, within_budget)."""
+    data = _encode_webp(image, profile, profile.max_quality)
+    if len(data) <= max_bytes:
+        return data, profile.max_quality, True
+    best, lowest = _bisect_webp(image, profile, max_bytes, profile.min_quality, profile.max_quality - 1)
+    if best is not None:
+        return best[0], best[1], True
+    return _at_min_quality(image, profile, lowest), profile.min_quality, False
+
+
+def _search_webp_from_estimate(image, profile, small, small_bytes, estimate):
+    """
+    _search_webp() on a large image in at most SEARCH_FULL_ENCODES full-size
+    encodes, starting from estimate, the quality found on the reduced copy
+    small, whose encode at estimate was small_bytes long. See the module
+    docstring for how each next quality is picked.
+    """
+    remaining = max(1, SEARCH_FULL_ENCODES)
+    best = lowest = None  # (data, quality): the best encode that fits, the lowest quality that does not
+    small_sizes = {estimate: small_bytes}
+    # Illinois weights of the two ends of the bracket, and which end the last encode moved.
+    fit_weight = miss_weight = 1.0
+    moved = None
+
+    def attempt(quality):
+        nonlocal best, lowest, remaining, fit_weight, miss_weight, moved
+        data = _encode_webp(image, profile, quality)
+        remaining -= 1
+        if len(data) <= profile.max_bytes:
+            if best is None or quality > best[1]:
+                best = (data, quality)
+            fit_weight = 1.0
+            if moved == "fit":
+                miss_weight /= 2
+            moved = "fit"
+        else:
+            if lowest is None or quality < lowest[1]:
+                lowest = (data, quality)
+            miss_weight = 1.0
+            if moved == "miss":
+                fit_weight /= 2
+            moved = "miss"
+        return data
+
+    def bounds():
+        low = best[1] + 1 if best else profile.min_quality
+        high = lowest[1] - 1 if lowest else profile.max_quality
+        return low, high
+
+    quality = estimate
+    data = attempt(quality)
+    if remaining and quality < profile.max_quality and len(data) <= profile.max_bytes * SEARCH_HEADROOM:
+        quality = profile.max_quality
+        data = attempt(quality)
+        small_sizes[quality] = len(_encode_webp(small, profile, quality))
+
+    low, high = bounds()
+    last_span = None
+    while remaining and low <= high:
+        if best is not None and lowest is not None:
+            if last_span is not None and high - low > last_span / 2:
+                # The last step shrank the bracket by less than half: bisect instead.
+                quality = (low + high) // 2
+            else:
+                # False position between the full-size encodes on either side of the budget. An end
+                # that stays put twice running has its weight halved (the Illinois correction), so the
+                # estimate moves towards it instead of creeping up from the other end. WebP sizes are
+                # not smooth in quality, so the estimate is also kept off the ends of the bracket.
+                (fit, fit_quality), (miss, miss_quality) = best, lowest
+                under = (profile.max_bytes - len(fit)) * fit_weight
+                over = (len(miss) - profile.max_bytes) * miss_weight
+                quality = round(fit_quality + under / (under + over) * (miss_quality - fit_quality))
+                margin = (high - low) // 4
+                quality = min(max(quality, low + margin), high - margin)
+            last_span = high - low
+        else:
+            # One-sided: correct the reduced copy's per-pixel bias with the full/reduced size ratio
+            # measured at the last quality tried. An estimate at or below the best fit ends the search.
+            small_data, corrected, _ = _search_webp(small, profile, profile.max_bytes * small_sizes[quality] / len(data))
+            if corrected < low:
+                break
+            quality = min(corrected, high)
+            small_sizes[quality] = len(small_data) if quality == corrected else len(_encode_webp(small, profile, quality))
+        data = attempt(quality)
+        low, high = bounds()
+
+    if best is not None:
+        return best[0], best[1], True
+    return _at_min_quality(image, profile, lowest), profile.min_quality, False
+
+
+def encode(image, profile):
+    """
+    Encode image with profile. Returns (data, setting, within_budget), setting
+    being the WEBP quality or "truecolor"/"palette" for PNG.
+    """
+    if profile.format == "PNG":
+        data = _encode_png(image, palette=False)
+        if len(data) <= profile.max_bytes:
+            return data, "truecolor", True
+        data = _encode_png(image, palette=True)
+        return data, "palette", len(data) <= profile.max_bytes
+
+    pixels = image.width * image.height
+    if pixels <= SEARCH_MAX_PIXELS:
+        return _search_webp(image, profile, profile.max_bytes)
+
+    small = image.reduce(math.ceil(math.sqrt(pixels / SEARCH_MAX_PIXELS)))
+    try:
+        small_data, estimate, _ = _search_webp(small, profile, profile.max_bytes * small.width * small.height / pixels)
+        return _search_webp_from_estimate(image, profile, small, len(small_data), estimate)
+    finally:
+        small.close()
+
+
+def save(image, path, profile):
+    """encode() image and write it atomically to path. Returns (bytes written, setting, within_budget)."""
+    data, setting, within_budget = encode(image, profile)
+    partial = path + ".part"
+    with open(partial, "wb") as f:
+        f.write(data)
+    os.replace(partial, path)
+    return len(data), setting, within_budget
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def submit(fn, *args, **kwargs):
+    """Run fn (typically a save()) on the process-wide encoder pool; returns its Future."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max(1, ENCODE_WORKERS), thread_name_prefix="encode")
+    return _executor.submit(fn, *args, **kwargs)
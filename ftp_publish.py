@@ -0,0 +1,326 @@
+"""
+STEP 7 uploads to the Hostinger FTP account through a pool of logged-in connections.
+
+process_folder used to open a new ftplib.FTP login for every folder, upload
+its files one by one and quit, which on a busy week meant hundreds of
+TCP + login handshakes. FTPPool keeps up to FTP_UPLOAD_WORKERS authenticated
+connections for the whole run, checks a connection with NOOP before reusing it
+after FTP_IDLE_CHECK seconds idle, and transparently reconnects when the server
+has dropped it. FTPPublisher sends uploads from every folder through the pool
+in parallel.
+
+FTPPublisher.publish() only transfers bytes that changed. Each remote
+directory is listed once per run (MLSD, falling back to NLST), and the
+manifest records the size and sha256 of everything published. A file is
+skipped when the local copy matches that record and the remote listing still
+shows it with the same size. A size match alone is never trusted: a file
+with no record yet is uploaded once, which records it.
+"""
+import ftplib
+import hashlib
+import os
+import posixpath
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from run_metrics import metrics
+
+FTP_UPLOAD_WORKERS = int(os.environ.get("FTP_UPLOAD_WORKERS", "4"))
+FTP_TIMEOUT = int(os.environ.get("FTP_TIMEOUT", "60"))
+FTP_IDLE_CHECK = int(os.environ.get("FTP_IDLE_CHECK", "30"))
+
+# Errors that can mean "this connection is gone", as opposed to a refused command (see connection_lost).
+CONNECTION_ERRORS = (EOFError, OSError, ftplib.error_temp, ftplib.error_reply)
+
+
+def connection_lost(error):
+    """True if error means the connection is gone. Of the 4xx replies only 421 (closing connection) does."""
+    if isinstance(error, ftplib.error_temp):
+        return str(error).startswith("421")
+    return isinstance(error, CONNECTION_ERRORS)
+
+
+class FTPPool:
+    def __init__(self, host, user, password, size=FTP_UPLOAD_WORKERS):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.size = max(1, size)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self.logins = 0
+
+    def _connect(self):
+        ftp = ftplib.FTP(self.host, self.user, self.password, timeout=FTP_TIMEOUT)
+        with self._lock:
+            self.logins += 1
+        return ftp
+
+    def _alive(self, ftp):
+        try:
+            ftp.voidcmd("NOOP")
+            return True
+        except CONNECTION_ERRORS as e:
+            return not connection_lost(e)
+
+    def _borrow(self):
+        try:
+            ftp, idle_since = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            ftp, idle_since = self._idle.get()
+        if time.monotonic() - idle_since > FTP_IDLE_CHECK and not self._alive(ftp):
+            self._discard(ftp)
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return ftp
+
+    def _discard(self, ftp):
+        try:
+            ftp.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        ftp = self._borrow()
+        try:
+            yield ftp
+        except CONNECTION_ERRORS as e:
+            if connection_lost(e):
+                # Don't return a broken connection to the pool; the next borrower gets a fresh login.
+                self._discard(ftp)
+                ftp = None
+            raise
+        finally:
+            if ftp is not None:
+                self._idle.put((ftp, time.monotonic()))
+            else:
+                with self._lock:
+                    self._created -= 1
+
+    def run(self, action):
+        """action(ftp) on a pooled connection, retried once on a new login if the connection dropped."""
+        try:
+            with self.connection() as ftp:
+                return action(ftp)
+        except CONNECTION_ERRORS as e:
+            if not connection_lost(e):
+                raise
+            with self.connection() as ftp:
+                return action(ftp)
+
+    def close(self):
+        while True:
+            try:
+                ftp, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                ftp.quit()
+            except Exception:
+                self._discard(ftp)
+
+
+def file_digest(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return os.path.getsize(path), sha256.hexdigest()
+
+
+def list_remote_dir(ftp, remote_dir):
+    """
+    {name: {"type": "file"/"dir"/None, "size": int or None}} for remote_dir,
+    or None if it does not exist. Uses MLSD when the server supports it.
+    """
+    try:
+        entries = {}
+        for name, facts in ftp.mlsd(remote_dir, facts=["type", "size"]):
+            if name in (".", ".."):
+                continue
+            size = facts.get("size")
+            entries[name] = {"type": facts.get("type"), "size": int(size) if size is not None else None}
+        return entries
+    except ftplib.error_perm as e:
+        if str(e).startswith("550"):
+            return None
+        if str(e)[:3] not in ("500", "501", "502", "504"):
+            raise
+    # MLSD not supported: names only.
+    try:
+        names = ftp.nlst(remote_dir)
+    except ftplib.error_perm as e:
+        if str(e).startswith("550"):
+            return None
+        raise
+    return {posixpath.basename(name.rstrip("/")): {"type": None, "size": None} for name in names}
+
+
+class FTPPublisher:
+    def __init__(self, pool, manifest=None, workers=None):
+        self.pool = pool
+        self.manifest = manifest
+        self.workers = workers or pool.size
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ftp")
+        self._lock = threading.Lock()
+        self._listings = {}
+        self.listings = 0
+        self.files_uploaded = 0
+        self.files_unchanged = 0
+        self.bytes_uploaded = 0
+        self.bytes_skipped = 0
+        self.upload_seconds = 0.0
+
+    def listing(self, remote_dir):
+        """Cached listing of remote_dir (see list_remote_dir); one LIST per directory per run."""
+        remote_dir = remote_dir.rstrip("/") or "/"
+        with self._lock:
+            if remote_dir in self._listings:
+                return self._listings[remote_dir]
+        entries = self.pool.run(lambda ftp: list_remote_dir(ftp, remote_dir))
+        with self._lock:
+            self.listings += 1
+            return self._listings.setdefault(remote_dir, entries)
+
+    def _remember(self, remote_path, entry):
+        parent, name = posixpath.split(remote_path.rstrip("/"))
+        with self._lock:
+            if self._listings.get(parent) is not None:
+                self._listings[parent][name] = entry
+            if entry["type"] == "dir":
+                self._listings.setdefault(remote_path.rstrip("/"), {})
+
+    def ensure_dirs(self, remote_dirs):
+        """Create the remote directories (parents first) that the cached listings don't already show."""
+        created = []
+        for remote_dir in remote_dirs:
+            parent, name = posixpath.split(remote_dir.rstrip("/"))
+            listing = self.listing(parent)
+            if listing is not None and name in listing:
+                continue
+
+            def mkd(ftp):
+                try:
+                    ftp.mkd(remote_dir)
+                    return True
+                except ftplib.error_perm as e:
+                    # 550 means folder exists on many servers
+                    if not str(e).startswith("550"):
+                        raise
+                    return False
+
+            if self.pool.run(mkd):
+                created.append(remote_dir)
+            self._remember(remote_dir, {"type": "dir", "size": None})
+        return created
+
+    def _upload_one(self, local_file, remote_file, replace):
+        def store(ftp):
+            # remove remote file if it exists, ignore permission errors
+            if replace:
+                try:
+                    ftp.delete(remote_file)
+                except ftplib.error_perm:
+                    pass
+            with open(local_file, 'rb') as f:
+                ftp.storbinary(f"STOR {remote_file}", f)
+
+        start = time.perf_counter()
+        try:
+            self.pool.run(store)
+            error = None
+        except Exception as e:
+            error = e
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(local_file) if error is None else 0
+        with self._lock:
+            self.upload_seconds += elapsed
+            if error is None:
+                self.files_uploaded += 1
+                self.bytes_uploaded += size
+        metrics.event(
+            "step7_ftp_upload", duration=elapsed, status="ok" if error is None else "error",
+            path=remote_file, bytes_out=size, error=str(error) if error else None,
+        )
+        return local_file, remote_file, size, elapsed, error
+
+    def _is_unchanged(self, remote_file, size, sha256):
+        parent, name = posixpath.split(remote_file)
+        listing = self.listing(parent) or {}
+        remote = listing.get(name)
+        if remote is None:
+            return False
+        if remote["size"] is not None and remote["size"] != size:
+            return False
+        record = self.manifest.published_file(remote_file) if self.manifest else None
+        # No record (or no manifest): the remote bytes are unknown, so upload and record them.
+        return record is not None and tuple(record) == (size, sha256)
+
+    def publish(self, jobs):
+        """
+        jobs: list of (local_file, remote_file). Uploads only files whose bytes
+        differ from what was last published, in parallel on the pool. Returns
+        (local_file, remote_file, status, bytes, seconds, error) per job in
+        order, status being "uploaded", "unchanged" or "failed". Nothing is
+        printed here, so the calling folder keeps its log together.
+        """
+        digests = [file_digest(local_file) for local_file, _ in jobs]
+        results = [None] * len(jobs)
+        pending = []
+        for i, ((local_file, remote_file), (size, sha256)) in enumerate(zip(jobs, digests)):
+            if self._is_unchanged(remote_file, size, sha256):
+                results[i] = (local_file, remote_file, "unchanged", size, 0.0, None)
+                with self._lock:
+                    self.files_unchanged += 1
+                    self.bytes_skipped += size
+            else:
+                parent, name = posixpath.split(remote_file)
+                exists = name in (self.listing(parent) or {})
+                pending.append((i, self._executor.submit(self._upload_one, local_file, remote_file, exists)))
+
+        for i, future in pending:
+            local_file, remote_file, size, elapsed, error = future.result()
+            status = "failed" if error is not None else "uploaded"
+            results[i] = (local_file, remote_file, status, size, elapsed, error)
+            if error is None:
+                self._remember(remote_file, {"type": "file", "size": size})
+
+        if self.manifest:
+            self.manifest.mark_files_published(
+                (remote_file, size, sha256)
+                for (local_file, remote_file, status, _, _, _), (size, sha256) in zip(results, digests)
+                if status != "failed"
+            )
+        return results
+
+    def summary(self):
+        return (
+            f"FTP: {self.files_uploaded} file(s), {self.bytes_uploaded / (1024 * 1024):.1f} MB uploaded; "
+            f"{self.files_unchanged} unchanged file(s), {self.bytes_skipped / (1024 * 1024):.1f} MB not re-sent; "
+            f"{self.listings} directory listing(s) over {self.pool.logins} login(s) with {self.workers} worker(s) "
+            f"({self.upload_seconds:.1f}s of transfer time)."
+        )
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.pool.close()
@@ -0,0 +1,312 @@
+"""
+In-memory version of process_folder STEPs 1-6.
+
+The old steps wrote the 6000x4000 letterbox back over the source, reopened it
+for rembg, saved a .webp, slept and renamed it, then reopened that .webp twice
+more (PNG, thumbnail) and the thumbnail once more for the second rembg pass.
+Here every source is decoded once, the intermediates stay in memory and each
+derivative is written to disk exactly once, under its final name:
+
+    <folder>/<stem>.webp          background removed, 6000x4000
+    <folder>/PNG/<folder>.png     500x500, from the folder's hero image only
+    <folder>/images/<stem>.webp   400x270 on white
+
+The thumbnail reuses the STEP 2 mask, downscaled, rather than running rembg
+a second time on the already cut-out image. Both small derivatives (PNG and
+thumbnail) are resampled from one box-reduced level of the master and mask
+(Image.reduce), not from the 24 MP originals.
+
+Each step is recorded as a run_metrics event (duration, bytes, dimensions).
+
+Every intermediate is closed as soon as the next step no longer needs it; the
+master and mask go right after the reduced level is taken. How many images are
+in flight at once is bounded by the memory budget (see memory_budget.py), and
+each folder reports the peak RSS seen while it was processed.
+
+The encodes themselves run on encoding.submit()'s thread pool while the next
+batch is segmented; their results are collected (and logged, and the source
+deleted) one batch behind, on the calling thread so its log stays together.
+"""
+import os
+import re
+import threading
+
+from PIL import Image
+
+import bg_removal
+import encoding
+from bg_removal import get_remover
+from memory_budget import get_budget
+from run_metrics import metrics, rss_mb
+
+SOURCE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+MASTER_SIZE = (6000, 4000)
+PNG_SIZE = (500, 500)
+THUMB_SIZE = (400, 270)
+# The reduced level stays at least this many times larger than every small
+# derivative, so the final LANCZOS pass still has the detail it needs.
+REDUCE_HEADROOM = 2
+# The folder's 500x500 PNG is rendered once, from its hero image: the first
+# image (sorted by name) whose stem matches this pattern, e.g. W310-SBRL-01.jpg,
+# or simply the first image when none does.
+HERO_IMAGE_PATTERN = re.compile(os.environ.get("HERO_IMAGE_PATTERN", r"[-_]0*1$"))
+# Estimated MB held per image in flight: RGB master (3 bytes/pixel), its mask (1),
+# the RGBA cutout (4) and the letterbox resize/crop while STEP 1 runs (3).
+IMAGE_WORKING_SET_MB = MASTER_SIZE[0] * MASTER_SIZE[1] * 11 / (1024 * 1024)
+
+
+def letterbox(image, size):
+    """Scale image to fit size, centre it and paste it on a white RGB canvas (STEP 1/STEP 4)."""
+    target_width, target_height = size
+    original_width, original_height = image.size
+    aspect_ratio = original_width / original_height
+
+    if aspect_ratio > target_width / target_height:
+        desired_width = target_width
+        desired_height = int(target_width / aspect_ratio)
+    else:
+        desired_height = target_height
+        desired_width = int(target_height * aspect_ratio)
+
+    resized_image = image.resize((desired_width, desired_height), Image.LANCZOS)
+
+    crop_left = (desired_width - target_width) // 2
+    crop_top = (desired_height - target_height) // 2
+    crop_right = crop_left + target_width
+    crop_bottom = crop_top + target_height
+    cropped_image = resized_image.crop((crop_left, crop_top, crop_right, crop_bottom))
+
+    background_image = Image.new('RGB', (target_width, target_height), (255, 255, 255))
+    paste_left = (target_width - cropped_image.width) // 2
+    paste_top = (target_height - cropped_image.height) // 2
+    background_image.paste(cropped_image, (paste_left, paste_top))
+    cropped_image.close()
+    resized_image.close()
+    return background_image
+
+
+def on_white(image, mask):
+    """Composite image through mask onto an opaque white background (STEP 6)."""
+    background = Image.new('RGB', image.size, (255, 255, 255))
+    background.paste(image, (0, 0), mask)
+    return background
+
+
+def reduce_factor(size, targets, headroom=REDUCE_HEADROOM):
+    """Largest integer Image.reduce() factor for size that keeps headroom x every target size."""
+    width, height = size
+    factor = min(min(width // (w * headroom), height // (h * headroom)) for w, h in targets)
+    return max(1, factor)
+
+
+def select_hero(names):
+    """Hero image among file names (see HERO_IMAGE_PATTERN), or None if there are none."""
+    names = sorted(names)
+    for name in names:
+        if HERO_IMAGE_PATTERN.search(os.path.splitext(name)[0]):
+            return name
+    return names[0] if names else None
+
+
+def budget_note(setting, within_budget):
+    return f"setting {setting}" + ("" if within_budget else ", OVER BUDGET")
+
+
+def list_sources(folder_path):
+    return sorted(
+        f for f in os.listdir(folder_path)
+        if f.lower().endswith(SOURCE_EXTENSIONS) and os.path.isfile(os.path.join(folder_path, f))
+    )
+
+
+def build_derivatives(folder_path, folder, hero=None, render_png=True, profiles=encoding.PROFILES):
+    """
+    Turn every source image in folder_path into its published derivatives and
+    delete the source. Returns the source file names processed, in order; a
+    source that cannot be decoded is skipped, left in place and not returned.
+
+    The folder PNG is rendered from hero (a source file name), selected with
+    select_hero() when not given; render_png=False leaves it out entirely.
+    Every output is encoded with its profile in profiles (see encoding.py).
+    """
+    remover = get_remover()
+    budget = get_budget()
+    png_folder = os.path.join(folder_path, "PNG")
+    images_folder = os.path.join(folder_path, "images")
+    os.makedirs(png_folder, exist_ok=True)
+    os.makedirs(images_folder, exist_ok=True)
+
+    written = []
+    processed = []
+    sources = list_sources(folder_path)
+    if render_png and hero is None:
+        hero = select_hero(sources)
+    png_path = os.path.join(png_folder, folder + '.png')
+    peak_rss = rss_mb() or 0.0
+    # Sources are segmented batch_size at a time, one onnxruntime run per batch,
+    # and a batch only starts once the memory budget has room for all of it.
+    # Its share of the budget is returned once its last encode has finished.
+    batch_size = budget.capacity(IMAGE_WORKING_SET_MB, remover.batch_size)
+    pending = []
+    for batch_start in range(0, len(sources), batch_size):
+        names = sources[batch_start:batch_start + batch_size]
+        reserved = IMAGE_WORKING_SET_MB * len(names)
+        budget.acquire(reserved)
+        try:
+            batch_peak, jobs = _build_batch(folder_path, folder, names, hero, render_png, profiles)
+        except Exception:
+            budget.release(reserved)
+            raise
+        _release_when_encoded(budget, [job[3] for job in jobs], reserved)
+        peak_rss = max(peak_rss, batch_peak)
+        # The previous batch has been encoding while this one was segmented.
+        _collect(folder, pending, written, processed)
+        pending = jobs
+    _collect(folder, pending, written, processed)
+
+    if render_png and png_path not in written:
+        print(f"No 500x500 PNG for {folder}: hero image {hero} was not processed.")
+
+    metrics.event("folder_memory", folder=folder, images=len(sources), folder_peak_rss_mb=round(peak_rss, 1))
+    print(f"{folder}: peak RSS {peak_rss:.0f} MB while processing {len(sources)} image(s).")
+    if len(processed) < len(sources):
+        print(f"{len(sources) - len(processed)} of {len(sources)} image(s) in {folder} could not be processed.")
+    return processed
+
+
+def _encode(stage, derivative, path, profile, **fields):
+    """
+    Encoder-pool job: save() the derivative image with profile, record the
+    step (fields include image=<source file name>, like every other step)
+    and release the derivative.
+    """
+    try:
+        with metrics.timed(stage, **fields) as event:
+            size, setting, within_budget = encoding.save(derivative, path, profile)
+            event.update(bytes_out=size, setting=setting, within_budget=within_budget)
+    finally:
+        derivative.close()
+    return path, size, setting, within_budget
+
+
+def _release_when_encoded(budget, futures, mb):
+    """Give mb back to budget once every future (the encodes holding a batch's images) is done."""
+    if not futures:
+        budget.release(mb)
+        return
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            budget.release(mb)
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+def _collect(folder, jobs, written, processed):
+    """
+    Wait for a batch's encodes in order, log them and clean up each source
+    once its main .webp is on disk. Paths go to written and, once its last
+    derivative (the thumbnail) is done, the source file name to processed.
+    """
+    for kind, file, source_path, future in jobs:
+        path, size, setting, within_budget = future.result()
+        written.append(path)
+        note = f"{size / 1024:.0f} KB, {budget_note(setting, within_budget)}"
+        if kind == "main":
+            print(f"{file} background removed & saved as webp ({note}).")
+
+            # === STEP 3: Clean up the original ===
+            with metrics.timed("step3_cleanup", folder=folder, image=file):
+                os.remove(source_path)
+            print(f"{file} removed.")
+        elif kind == "png":
+            print(f"{path} saved as 500x500 PNG from hero image {file} ({note}).")
+        else:
+            print(f"{path} resized to 400x270 with white background ({note}).")
+            processed.append(file)
+
+
+def _build_batch(folder_path, folder, names, hero, render_png, profiles):
+    """
+    STEPs 1-6 for one segmentation batch of source file names, with every
+    encode submitted to the encoder pool. Returns the highest RSS (MB)
+    sampled on the way and the (kind, file, source_path, future) jobs.
+    """
+    remover = get_remover()
+    png_folder = os.path.join(folder_path, "PNG")
+    images_folder = os.path.join(folder_path, "images")
+    peak_rss = 0.0
+    jobs = []
+
+    batch = []
+    for file in names:
+        source_path = os.path.join(folder_path, file)
+
+        # === STEP 1: Resize to 6000x4000 & white background ===
+        try:
+            with metrics.timed("step1_letterbox", folder=folder, image=file) as event, \
+                    Image.open(source_path) as original_image:
+                event.update(bytes_in=os.path.getsize(source_path), source_size=original_image.size)
+                master = letterbox(original_image, MASTER_SIZE)
+                event.update(width=master.width, height=master.height)
+        except Exception as e:
+            print(f"Skipping {source_path}: {e}")
+            continue
+        print(f"{source_path} resized to 6000x4000 with white background.")
+        batch.append((file, source_path, master))
+    if not batch:
+        return peak_rss, jobs
+
+    with metrics.timed("step2_rembg", folder=folder, images=len(batch), width=MASTER_SIZE[0], height=MASTER_SIZE[1]):
+        masks = remover.masks([master for _, _, master in batch])
+    peak_rss = max(peak_rss, rss_mb() or 0.0)
+    for (file, source_path, master), mask in zip(batch, masks):
+        stem = file.split(".")[0]
+
+        # === STEP 2: Remove background & save the main .webp under its final name ===
+        cutout = bg_removal.cutout(master, mask)
+        # The most this image holds at once: master, mask and cutout.
+        peak_rss = max(peak_rss, rss_mb() or 0.0)
+        webp_path = os.path.join(folder_path, stem + ".webp")
+        jobs.append(("main", file, source_path, encoding.submit(
+            _encode, "step2_webp", cutout, webp_path, profiles["main"],
+            folder=folder, image=file, width=cutout.width, height=cutout.height,
+        )))
+
+        # Shared by STEP 4-6: one reduced level of the master and mask; the full-size pair is released here.
+        with metrics.timed("reduce_level", folder=folder, image=file) as event:
+            factor = reduce_factor(master.size, (PNG_SIZE, THUMB_SIZE))
+            small_master, small_mask = master.reduce(factor), mask.reduce(factor)
+            master.close()
+            mask.close()
+            event.update(factor=factor, width=small_master.width, height=small_master.height)
+
+        # === STEP 4: 500x500 PNG, rendered once from the hero image ===
+        if render_png and file == hero:
+            png_path = os.path.join(png_folder, folder + '.png')
+            small_cutout = bg_removal.cutout(small_master, small_mask)
+            png_canvas = letterbox(small_cutout, PNG_SIZE)
+            small_cutout.close()
+            jobs.append(("png", file, source_path, encoding.submit(
+                _encode, "step4_png", png_canvas, png_path, profiles["png"],
+                folder=folder, image=file, width=PNG_SIZE[0], height=PNG_SIZE[1],
+            )))
+
+        # === STEP 5/6: 400x270 thumbnail on white, reusing the STEP 2 mask ===
+        thumb_master, thumb_mask = small_master.resize(THUMB_SIZE, Image.LANCZOS), small_mask.resize(THUMB_SIZE, Image.LANCZOS)
+        thumb = on_white(thumb_master, thumb_mask)
+        for image in (thumb_master, thumb_mask, small_master, small_mask):
+            image.close()
+        thumb_path = os.path.join(images_folder, stem + ".webp")
+        jobs.append(("thumb", file, source_path, encoding.submit(
+            _encode, "step5_6_thumbnail", thumb, thumb_path, profiles["thumb"],
+            folder=folder, image=file, width=THUMB_SIZE[0], height=THUMB_SIZE[1],
+        )))
+
+    return peak_rss, jobs
@@ -1,11 +1,15 @@
-import os
 import time
-import io
-from rembg import remove
-from PIL import Image
-import ftplib
+STARTED = time.perf_counter()  # for the startup breakdown at the end of main()
+import os
+import sys
+from ftp_publish import FTPPool, FTPPublisher
+from manifest import Manifest
 import dropbox
 from datetime import datetime
+# PIL, rembg and onnxruntime are imported by process_folder() through timed_import(),
+# only once a folder actually needs processing.
+from run_metrics import metrics, process_age, timed_import
+IMPORTED = time.perf_counter()
 
 # === Dropbox Setup ===
 dbx = dropbox.Dropbox(
@@ -21,6 +25,10 @@ FTP_HOST = os.environ["FTP_HOST"]
 FTP_USER = os.environ["FTP_USER"]
 FTP_PASS = os.environ["FTP_PASS"]
 REMOTE_BASE_PATH = '/domains/ipwstock.com/public_html/public/dropbox/'
+# Published size/sha256 per remote file, so unchanged derivatives are not re-sent.
+manifest = Manifest(".manifest.sqlite")
+publisher = FTPPublisher(FTPPool(FTP_HOST, FTP_USER, FTP_PASS, size=1), manifest=manifest)
+SET_UP = time.perf_counter()
 
 
 def get_last_run_time():
@@ -33,9 +41,22 @@ def update_last_run_time():
     with open(".last_run.txt", "w") as f:
         f.write(datetime.utcnow().isoformat())
 
-def download_dropbox_folder(local_base, dropbox_path, last_run):
+def timed_listing(call, *args):
+    """One files_list_folder(_continue) call, added to the "listing" startup phase."""
+    start = time.perf_counter()
+    try:
+        return call(*args)
+    finally:
+        metrics.phase("listing", time.perf_counter() - start)
+
+
+def download_dropbox_folder(local_base, dropbox_path, last_run, listed=None):
+    """
+    Download the images under dropbox_path modified since last_run. The names
+    of every image directly in the folder, new or not, are appended to listed.
+    """
     try:
-        result = dbx.files_list_folder(dropbox_path)
+        result = timed_listing(dbx.files_list_folder, dropbox_path)
     except dropbox.exceptions.ApiError as e:
         print(f"Error listing {dropbox_path}: {e}")
         return False
@@ -50,6 +71,8 @@ def download_dropbox_folder(local_base, dropbox_path, last_run):
             if isinstance(entry, dropbox.files.FileMetadata):
                 # Only download images
                 if entry.name.lower().endswith(('.jpg', '.png')):
+                    if listed is not None:
+                        listed.append(entry.name)
                     if not last_run or entry.server_modified > last_run:
                         dbx.files_download_to_file(local_path, entry.path_lower)
                         print(f"Downloaded NEW file {entry.path_lower} -> {local_path}")
@@ -61,7 +84,7 @@ def download_dropbox_folder(local_base, dropbox_path, last_run):
                     
         if result.has_more:
             
-            result = dbx.files_list_folder_continue(result.cursor)
+            result = timed_listing(dbx.files_list_folder_continue, result.cursor)
             
         else:
         
@@ -69,199 +92,63 @@ def download_dropbox_folder(local_base, dropbox_path, last_run):
         
     return new_files
 
-def process_folder(base_folder, folder):
+def process_folder(base_folder, folder, listed):
     """
     Run your original STEP 1–7 processing logic
     on a given folder that’s already downloaded locally.
+    listed: every image name in the Dropbox folder, not just the new ones.
     """
     folder_path = os.path.join(base_folder, folder)
-
-    # === STEP 1: Resize to 6000x4000 & white background ===
-    file_list = os.listdir(folder_path)
-    for file in file_list:
-        image_path = os.path.join(folder_path, file)
-        if not os.path.isfile(image_path):
-            continue
-        try:
-            original_image = Image.open(image_path)
-        except:
-            continue
-
-        target_height, target_width = 4000, 6000
-        original_width, original_height = original_image.size
-        aspect_ratio = original_width / original_height
-
-        if aspect_ratio > target_width / target_height:
-            desired_width = target_width
-            desired_height = int(target_width / aspect_ratio)
-        else:
-            desired_height = target_height
-            desired_width = int(target_height * aspect_ratio)
-
-        resized_image = original_image.resize((desired_width, desired_height), Image.LANCZOS)
-
-        crop_left = (desired_width - target_width) // 2
-        crop_top = (desired_height - target_height) // 2
-        crop_right = crop_left + target_width
-        crop_bottom = crop_top + target_height
-
-        cropped_image = resized_image.crop((crop_left, crop_top, crop_right, crop_bottom))
-
-        background_image = Image.new('RGB', (target_width, target_height), (255, 255, 255))
-        paste_left = (target_width - cropped_image.width) // 2
-        paste_top = (target_height - cropped_image.height) // 2
-        background_image.paste(cropped_image, (paste_left, paste_top))
-        background_image.save(image_path)
-        print(f"{image_path} resized to 6000x4000 with white background.")
-
-    # === STEP 2: Remove background & convert to .webp ===
-    image_list = os.listdir(folder_path)
-    for image_file in image_list:
-        file_path = os.path.join(folder_path, image_file)
-        if not os.path.isfile(file_path):
-            continue
-        try:
-            img = Image.open(file_path)
-        except:
-            continue
-        remove_bg = remove(img)
-        webp_path = file_path + '.webp'
-        remove_bg.save(webp_path, format="webp", optimize=True, quality=80)
-        print(f"{image_file} background removed & saved as webp.")
-
-    # === STEP 3: Clean up original images ===
-    rm_image_list = os.listdir(folder_path)
-    for rm_image in rm_image_list:
-        rm_file_path = os.path.join(folder_path, rm_image)
-        time.sleep(1)
-        if rm_image.endswith('.webp'):
-            filename, extension = os.path.splitext(rm_file_path)
-            new_file_path = filename.split(".")[0] + extension
-            os.rename(rm_file_path, new_file_path)
-        elif rm_image.lower().endswith(('.jpg', '.png')):
-            os.remove(rm_file_path)
-            print(f"{rm_image} removed.")
-
-    # === STEP 4: Create PNG folder & save 500x500 PNG ===
+    image_pipeline = timed_import("image_pipeline", "image stack import")
+
+    # === STEP 1-6: Build the main .webp, PNG and 400x270 images in memory ===
+    # The folder PNG always comes from the hero of the whole folder (see image_pipeline.select_hero);
+    # when the hero is not among this run's downloads, the published PNG is left as is.
+    hero = image_pipeline.select_hero(listed)
+    render_png = hero in image_pipeline.list_sources(folder_path)
+    if not render_png:
+        print(f"Hero image {hero} unchanged; keeping the published PNG for {folder}.")
+    image_pipeline.build_derivatives(folder_path, folder, hero=hero if render_png else None, render_png=render_png)
     png_folder = os.path.join(folder_path, "PNG")
-    if not os.path.exists(png_folder):
-        os.mkdir(png_folder)
-    for file in os.listdir(folder_path):
-        if file not in ("PNG", "images") and file.lower().endswith('.webp'):
-            image_path = os.path.join(folder_path, file)
-            img = Image.open(image_path)
-            target_height, target_width = 500, 500
-            original_width, original_height = img.size
-            aspect_ratio = original_width / original_height
-            if aspect_ratio > target_width / target_height:
-                desired_width = target_width
-                desired_height = int(target_width / aspect_ratio)
-            else:
-                desired_height = target_height
-                desired_width = int(target_height * aspect_ratio)
-            resized_image = img.resize((desired_width, desired_height), Image.LANCZOS)
-            crop_left = (desired_width - target_width) // 2
-            crop_top = (desired_height - target_height) // 2
-            crop_right = crop_left + target_width
-            crop_bottom = crop_top + target_height
-            cropped_image = resized_image.crop((crop_left, crop_top, crop_right, crop_bottom))
-            background_image = Image.new('RGB', (target_width, target_height), (255, 255, 255))
-            paste_left = (target_width - cropped_image.width) // 2
-            paste_top = (target_height - cropped_image.height) // 2
-            background_image.paste(cropped_image, (paste_left, paste_top))
-            png_path = os.path.join(png_folder, folder + '.png')
-            background_image.save(png_path, format="png", optimize=True, quality=10)
-            print(f"{image_path} saved as 500x500 PNG.")
-
-    # === STEP 5: Create images folder & save 400x270 images ===
     images_folder = os.path.join(folder_path, "images")
-    if not os.path.exists(images_folder):
-        os.mkdir(images_folder)
-    for file in os.listdir(folder_path):
-        if file not in ("PNG", "images") and file.lower().endswith('.webp'):
-            image_path = os.path.join(folder_path, file)
-            img = Image.open(image_path)
-            resized_image = img.resize((400, 270), Image.LANCZOS)
-            save_path = os.path.join(images_folder, file)
-            resized_image.save(save_path)
-            print(f"{image_path} resized to 400x270 in images folder.")
-
-    # === STEP 6: Remove background again in /images & set white background ===
-    for image_file in os.listdir(images_folder):
-        if image_file.endswith('.webp'):
-            input_image_path = os.path.join(images_folder, image_file)
-            with open(input_image_path, "rb") as f:
-                image_data = f.read()
-            result = remove(image_data)
-            image = Image.open(io.BytesIO(result)).convert("RGBA")
-            background = Image.new('RGBA', image.size, (255, 255, 255, 255))
-            background.paste(image, (0, 0), image)
-            background.save(input_image_path, format="WEBP")
-            print(f"{input_image_path} white background reapplied.")
 
     # === STEP 7: Store Image to hostinger account ===
-    ftp = ftplib.FTP(FTP_HOST, FTP_USER, FTP_PASS)
-    ftp.cwd(REMOTE_BASE_PATH)
-
-    remote_folder_path = os.path.join(REMOTE_BASE_PATH, folder)
-    remote_folders = ftp.nlst()
-    if folder not in remote_folders:
-        ftp.mkd(remote_folder_path)
-        print(f"'{folder}' created on the remote server.")
-
-    def upload_folder(local_path, remote_path):
-        """Uploads all files in a folder to FTP, skipping existing files."""
-        try:
-            ftp.mkd(remote_path)
-            print(f"Created remote directory: {remote_path}")
-        except ftplib.error_perm as e:
-            if not str(e).startswith("550"):
-                raise
-        for filename in os.listdir(local_path):
-            local_file = os.path.join(local_path, filename)
-            remote_file = f"{remote_path}/{filename}"
-            if os.path.isfile(local_file):
-                try:
-                    ftp.size(remote_file)
-                    print(f"'{remote_file}' already exists on the remote server.")
-                except ftplib.error_perm as e:
-                    if "550" in str(e):
-                        with open(local_file, 'rb') as f:
-                            ftp.storbinary(f"STOR {remote_file}", f)
-                        print(f"Uploaded: {remote_file}")
-                    else:
-                        print(f"Error checking '{remote_file}': {str(e)}")
-
-    # Upload main .webp
-    main_webp_list = [x for x in os.listdir(folder_path) if x.endswith('.webp')]
-    for webp_image in main_webp_list:
-        local_image_path = os.path.join(folder_path, webp_image)
-        server_path = f"{remote_folder_path}/{webp_image}"
-        try:
-            ftp.size(server_path)
-            print(f"'{server_path}' already exists on the remote server.")
-        except ftplib.error_perm as e:
-            if "550" in str(e):
-                with open(local_image_path, 'rb') as f:
-                    ftp.storbinary(f"STOR {server_path}", f)
-                print(f"'{server_path}' transferred to the remote server.")
-            else:
-                print(f"Error checking '{webp_image}': {str(e)}")
-
-    # Upload images & PNG folders
-    if os.path.exists(images_folder):
-        upload_folder(images_folder, f"{remote_folder_path}/images")
-    if os.path.exists(png_folder):
-        upload_folder(png_folder, f"{remote_folder_path}/PNG")
-
-    ftp.quit()
+    # One listing per remote directory; only files whose bytes changed are sent (see ftp_publish).
+    remote_folder_path = f"{REMOTE_BASE_PATH.rstrip('/')}/{folder}"
+    for created in publisher.ensure_dirs([remote_folder_path, f"{remote_folder_path}/images", f"{remote_folder_path}/PNG"]):
+        print(f"'{created}' created on the remote server.")
+
+    jobs = [
+        (os.path.join(folder_path, x), f"{remote_folder_path}/{x}")
+        for x in os.listdir(folder_path) if x.endswith('.webp')
+    ]
+    for local_path, remote_path in ((images_folder, f"{remote_folder_path}/images"), (png_folder, f"{remote_folder_path}/PNG")):
+        if os.path.exists(local_path):
+            jobs += [
+                (os.path.join(local_path, x), f"{remote_path}/{x}")
+                for x in os.listdir(local_path) if os.path.isfile(os.path.join(local_path, x)) and not x.endswith(".part")
+            ]
+
+    for local_file, remote_file, status, size, seconds, error in publisher.publish(jobs):
+        if status == "failed":
+            print(f"Error uploading '{remote_file}': {error}")
+        elif status == "unchanged":
+            print(f"'{remote_file}' already up to date on the remote server.")
+        else:
+            print(f"Uploaded: {remote_file}")
 
 def main():
     last_run = get_last_run_time()
     local_downloads = "downloads"
     os.makedirs(local_downloads, exist_ok=True)
     
-    result = dbx.files_list_folder(MAIN_FOLDER)
+    age = process_age()
+    if age is not None:
+        metrics.phase("interpreter", max(0.0, age - (time.perf_counter() - STARTED)))
+    metrics.phase("imports", IMPORTED - STARTED)
+    metrics.phase("setup", SET_UP - IMPORTED)
+    # Listing is interleaved with the downloads; every listing call adds to the "listing" phase.
+    result = timed_listing(dbx.files_list_folder, MAIN_FOLDER)
 
     while True:
         for entry in result.entries:
@@ -270,20 +157,30 @@ def main():
                 os.makedirs(local_path, exist_ok=True)
                 print(f"Checking folder: {entry.name}")
                 
-                has_new = download_dropbox_folder(local_path, entry.path_lower, last_run)
+                listed = []
+                has_new = download_dropbox_folder(local_path, entry.path_lower, last_run, listed)
                 if has_new:
                     try:
-                        process_folder(local_downloads, entry.name)
+                        process_folder(local_downloads, entry.name, listed)
                     except Exception as e:
                         print(f"Error processing {entry.name}: {e}")
 
         if result.has_more:
-            result = dbx.files_list_folder_continue(result.cursor)
+            result = timed_listing(dbx.files_list_folder_continue, result.cursor)
         else:
             break
 
     # Update timestamp once all folders are processed
     update_last_run_time()
+    if "image_pipeline" in sys.modules:
+        print(sys.modules["image_pipeline"].get_remover().summary())
+        print(sys.modules["image_pipeline"].get_budget().summary())
+    else:
+        print("Image stack never loaded: no folder needed processing.")
+    print(metrics.startup_table())
+    print(publisher.summary())
+    publisher.close()
+    manifest.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,229 @@
+"""
+SQLite record of the Dropbox source images that have been processed and published.
+
+shared-link-v2.py picks images by "modified this month", so without this the
+same photos were downloaded and pushed through rembg on every weekly run of
+the month. Sources are keyed by their path inside the shared link together
+with Dropbox's content_hash, so a re-upload of the same bytes is still
+skipped while any real change gets processed again.
+
+The same database records every file published to FTP (remote path, size and
+sha256), so STEP 7 can leave unchanged derivatives alone.
+
+It also journals each folder in flight: every source it is meant to publish,
+the subset that got through the last stage finished (download_failed,
+downloaded, then processed) and its hero image. The sources that are published
+are marked so in the same transaction that closes the row. If some never got
+through, for example a failed download, the row stays as "pending" with just
+those sources. After a crash or a partial run, the next run therefore knows
+exactly which folders to resume, from where, and which images are still owed.
+
+A source that still is not published after SOURCE_MAX_ATTEMPTS runs (one that
+never decodes, say) is not owed forever: it is recorded in failed_sources and
+dropped from the journal, and is skipped until its content_hash changes.
+"""
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+SOURCE_MAX_ATTEMPTS = int(os.environ.get("SOURCE_MAX_ATTEMPTS", "3"))
+
+
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        # Folder workers share one connection; the lock serialises access to it.
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sources (
+                    path TEXT PRIMARY KEY,
+                    content_hash TEXT NOT NULL,
+                    processed_at TEXT,
+                    published_at TEXT
+                )
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS published_files (
+                    remote_path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    published_at TEXT NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS folder_journal (
+                    folder TEXT PRIMARY KEY,
+                    stage TEXT NOT NULL,
+                    sources TEXT NOT NULL,
+                    done TEXT NOT NULL,
+                    hero TEXT,
+                    updated_at TEXT NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS failed_sources (
+                    path TEXT PRIMARY KEY,
+                    content_hash TEXT NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    failed_at TEXT NOT NULL
+                )
+                """
+            )
+
+    def is_published(self, path, content_hash):
+        if not content_hash:
+            return False
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM sources WHERE path = ? AND content_hash = ? AND published_at IS NOT NULL",
+                (path.lower(), content_hash),
+            ).fetchone()
+        return row is not None
+
+    def has_failed(self, path, content_hash):
+        """True if path with this content_hash was given up on after SOURCE_MAX_ATTEMPTS runs."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM failed_sources WHERE path = ? AND content_hash = ? AND attempts >= ?",
+                (path.lower(), content_hash, SOURCE_MAX_ATTEMPTS),
+            ).fetchone()
+        return row is not None
+
+    def _count_failures(self, sources):
+        """One more failed run for each of sources; returns those now out of attempts."""
+        now = datetime.utcnow().isoformat()
+        self._conn.executemany(
+            """
+            INSERT INTO failed_sources (path, content_hash, attempts, failed_at) VALUES (?, ?, 1, ?)
+            ON CONFLICT(path) DO UPDATE SET
+                attempts = CASE WHEN content_hash = excluded.content_hash THEN attempts + 1 ELSE 1 END,
+                content_hash = excluded.content_hash,
+                failed_at = excluded.failed_at
+            """,
+            [(path.lower(), content_hash, now) for path, content_hash in sources],
+        )
+        exhausted = {
+            path for path, in self._conn.execute("SELECT path FROM failed_sources WHERE attempts >= ?", (SOURCE_MAX_ATTEMPTS,))
+        }
+        return [(path, content_hash) for path, content_hash in sources if path.lower() in exhausted]
+
+    def _upsert_published(self, sources):
+        now = datetime.utcnow().isoformat()
+        self._conn.executemany(
+            """
+            INSERT INTO sources (path, content_hash, processed_at, published_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET
+                content_hash = excluded.content_hash,
+                processed_at = excluded.processed_at,
+                published_at = excluded.published_at
+            """,
+            [(path.lower(), content_hash, now, now) for path, content_hash in sources],
+        )
+        self._conn.executemany("DELETE FROM failed_sources WHERE path = ?", [(path.lower(),) for path, _ in sources])
+
+    def mark_published(self, sources):
+        """sources: iterable of (path, content_hash) that went through STEP 1-7."""
+        with self._lock, self._conn:
+            self._upsert_published(sources)
+
+    def folder_stage(self, folder):
+        """(stage, sources, done, hero) journaled for folder by an unfinished run, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT stage, sources, done, hero FROM folder_journal WHERE folder = ?",
+                (folder,),
+            ).fetchone()
+        if row is None:
+            return None
+        stage, sources, done, hero = row
+        sources = [tuple(source) for source in json.loads(sources)]
+        done = [tuple(source) for source in json.loads(done)]
+        return stage, sources, done, hero
+
+    def journaled_folders(self):
+        with self._lock:
+            return {folder for folder, in self._conn.execute("SELECT folder FROM folder_journal")}
+
+    def _record_stage(self, folder, stage, sources, done, hero):
+        self._conn.execute(
+            """
+            INSERT INTO folder_journal (folder, stage, sources, done, hero, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(folder) DO UPDATE SET
+                stage = excluded.stage,
+                sources = excluded.sources,
+                done = excluded.done,
+                hero = excluded.hero,
+                updated_at = excluded.updated_at
+            """,
+            (folder, stage, json.dumps(sorted(sources)), json.dumps(sorted(done)), hero, datetime.utcnow().isoformat()),
+        )
+
+    def record_stage(self, folder, stage, sources, hero, done):
+        """
+        Journal that folder finished stage ("download_failed", "downloaded" or
+        "processed"). sources is every (path, content_hash) the folder owes this
+        round, done the ones that got through stage.
+        """
+        with self._lock, self._conn:
+            self._record_stage(folder, stage, list(sources), list(done), hero)
+
+    def forget_folder(self, folder):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM folder_journal WHERE folder = ?", (folder,))
+
+    def finish_folder(self, folder, published, sources):
+        """
+        mark_published(published) and close folder's journal entry, atomically.
+        Any of sources not published stays journaled as "pending", unless this
+        was its SOURCE_MAX_ATTEMPTS-th run; it is then recorded as failed.
+        Returns (pending, failed).
+        """
+        published = list(published)
+        missing = sorted(set(map(tuple, sources)) - set(map(tuple, published)))
+        with self._lock, self._conn:
+            self._upsert_published(published)
+            failed = self._count_failures(missing)
+            pending = [source for source in missing if source not in failed]
+            if pending:
+                self._record_stage(folder, "pending", pending, [], None)
+            else:
+                self._conn.execute("DELETE FROM folder_journal WHERE folder = ?", (folder,))
+        return pending, failed
+
+    def published_file(self, remote_path):
+        """(size, sha256) last published to remote_path, or None."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT size, sha256 FROM published_files WHERE remote_path = ?",
+                (remote_path,),
+            ).fetchone()
+
+    def mark_files_published(self, files):
+        """files: iterable of (remote_path, size, sha256) now on the FTP server."""
+        now = datetime.utcnow().isoformat()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                """
+                INSERT INTO published_files (remote_path, size, sha256, published_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(remote_path) DO UPDATE SET
+                    size = excluded.size,
+                    sha256 = excluded.sha256,
+                    published_at = excluded.published_at
+                """,
+                [(remote_path, size, sha256, now) for remote_path, size, sha256 in files],
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
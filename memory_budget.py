@@ -0,0 +1,96 @@
+"""
+Memory budget for the images build_derivatives() holds at once.
+
+Every source in flight costs several full-size copies: the 6000x4000 RGB
+master (72 MB), its mask (24 MB), the RGBA cutout (96 MB) and the letterbox
+intermediates while STEP 1 runs. With FOLDER_WORKERS folders and segmentation
+batches of SEGMENT_BATCH_SIZE, that is enough to exhaust a runner.
+
+With MEMORY_BUDGET_MB set, MemoryBudget caps the process: a batch of images is
+only admitted while the estimated working set of everything already admitted
+plus the new batch fits, and while the measured RSS leaves room for it. One
+batch is always let through when nothing else is in flight, so a budget that
+is too small slows the run down to one image at a time but never stalls it.
+Batches are shrunk to what the budget can hold (see capacity()).
+
+MEMORY_BUDGET_MB=0 (the default) leaves memory unbounded.
+"""
+import os
+import threading
+import time
+
+from run_metrics import rss_mb
+
+MEMORY_BUDGET_MB = int(os.environ.get("MEMORY_BUDGET_MB", "0"))
+# How often a waiting worker re-reads the RSS, which can drop without a release().
+RSS_POLL_SECONDS = 0.5
+
+
+class MemoryBudget:
+    def __init__(self, budget_mb=MEMORY_BUDGET_MB):
+        self.budget_mb = budget_mb
+        self._cond = threading.Condition()
+        self.in_use_mb = 0.0
+        self.peak_in_use_mb = 0.0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    @property
+    def bounded(self):
+        return self.budget_mb > 0
+
+    def capacity(self, cost_mb, wanted):
+        """How many items of cost_mb to admit together: at most wanted, at least 1."""
+        if not self.bounded:
+            return wanted
+        return max(1, min(wanted, int(self.budget_mb // cost_mb)))
+
+    def _fits(self, mb):
+        if not self.in_use_mb:
+            return True
+        if self.in_use_mb + mb > self.budget_mb:
+            return False
+        rss = rss_mb()
+        return rss is None or rss + mb <= self.budget_mb
+
+    def acquire(self, mb):
+        """Block until mb more can be held within the budget."""
+        if not self.bounded:
+            return
+        with self._cond:
+            if not self._fits(mb):
+                self.waits += 1
+                start = time.perf_counter()
+                while not self._fits(mb):
+                    self._cond.wait(RSS_POLL_SECONDS)
+                self.wait_seconds += time.perf_counter() - start
+            self.in_use_mb += mb
+            self.peak_in_use_mb = max(self.peak_in_use_mb, self.in_use_mb)
+
+    def release(self, mb):
+        if not self.bounded:
+            return
+        with self._cond:
+            self.in_use_mb = max(0.0, self.in_use_mb - mb)
+            self._cond.notify_all()
+
+    def summary(self):
+        if not self.bounded:
+            return "Memory budget: unbounded (set MEMORY_BUDGET_MB to cap it)."
+        return (
+            f"Memory budget: {self.budget_mb} MB; at most {self.peak_in_use_mb:.0f} MB of images in flight; "
+            f"{self.waits} wait(s), {self.wait_seconds:.1f}s spent waiting for room."
+        )
+
+
+_default_budget = None
+_default_lock = threading.Lock()
+
+
+def get_budget():
+    """Process-wide budget shared by every folder worker."""
+    global _default_budget
+    with _default_lock:
+        if _default_budget is None:
+            _default_budget = MemoryBudget()
+        return _default_budget
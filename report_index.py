@@ -0,0 +1,321 @@
+"""
+SQLite index over the weekly reports in reports/.
+
+The report-*.txt logs are mostly "Processing folder / Skipping folder" lines,
+so "when was 310-SBRL last published?" meant grepping every one of them. This
+keeps one row per run, one row per folder per run (status + detail) and one
+row per file event (downloaded / published / unchanged / failed), indexed by
+SKU, date and status:
+
+    python report_index.py backfill                 # parse every reports/report-*.txt
+    python report_index.py ingest reports/report-2025-10-19.txt
+    python report_index.py sku 310-SBRL             # history of one SKU, newest first
+    python report_index.py date 2025-10-19 --status published
+    python report_index.py status failed --since 2025-09-01
+
+Ingesting a report replaces whatever the index held for that date, so
+backfill can be repeated safely.
+
+The index is a local cache, not committed: the reports are the record, and
+indexing all of them takes a second or two. The query commands first index
+any report in reports/ that the index does not hold yet, so the index is
+built on first use and picks up each new weekly report by itself.
+"""
+import argparse
+import glob
+import os
+import posixpath
+import re
+import sqlite3
+from datetime import datetime
+
+REPORTS_DIR = "reports"
+INDEX_PATH = os.path.join(REPORTS_DIR, "history.sqlite")
+
+# Folder status, from least to most significant: a folder that was skipped by
+# one line and published by another in the same run is "published".
+STATUS_RANK = {"checked": 0, "skipped": 1, "unchanged": 2, "published": 3, "failed": 4}
+
+REPORT_NAME = re.compile(r"report-(\d{4}-\d{2}-\d{2})\.txt$")
+PATTERNS = [
+    ("folder", re.compile(r"^Processing folder: (?P<sku>.+)$")),
+    ("folder", re.compile(r"^Checking folder: (?P<sku>.+)$")),
+    ("skipped", re.compile(r"^Skipping folder (?P<sku>.+?): (?P<detail>.+)$")),
+    ("failed", re.compile(r"^Error processing (?P<sku>.+?): (?P<detail>.*)$")),
+    ("summary", re.compile(r"^(?P<status>PROCESSED|FAILED)\s+(?P<sku>.+?)(?:: (?P<detail>.*))?$")),
+    ("unchanged_folders", re.compile(r"^Skipping (?P<count>\d+) folder\(s\) with no changes since the last run\.$")),
+    ("downloaded", re.compile(r"^Downloaded (?P<path>/\S.*?) -> ")),
+    ("download_failed", re.compile(r"^Failed to download (?P<path>/\S.*?): (?P<detail>.*)$")),
+    ("published", re.compile(r"^'(?P<path>.+)' transferred to the remote server\.$")),
+    ("published", re.compile(r"^Uploaded/Updated: (?P<path>\S+)")),
+    ("unchanged", re.compile(r"^Unchanged, not re-sent: (?P<path>\S+)$")),
+    ("upload_failed", re.compile(r"^Failed to upload (?P<path>\S+): (?P<detail>.*)$")),
+]
+
+
+def remote_sku(remote_path):
+    """SKU folder of a published path: .../dropbox/<sku>/[images/|PNG/]file."""
+    parent = posixpath.dirname(remote_path)
+    if posixpath.basename(parent) in ("images", "PNG"):
+        parent = posixpath.dirname(parent)
+    return posixpath.basename(parent)
+
+
+def dropbox_sku(dropbox_path):
+    """SKU folder of a path inside the shared link: /<sku>/file."""
+    return dropbox_path.lstrip("/").split("/", 1)[0]
+
+
+def parse_report(lines):
+    """
+    Parse one report. Returns (folders, files, unchanged_folders): folders maps
+    sku -> (status, detail), files is a list of (sku, path, event, detail).
+    """
+    folders = {}
+    files = []
+    unchanged_folders = 0
+
+    def set_status(sku, status, detail=None):
+        current = folders.get(sku)
+        if current is None or STATUS_RANK[status] >= STATUS_RANK[current[0]]:
+            folders[sku] = (status, detail if detail is not None else (current[1] if current else None))
+
+    for line in lines:
+        line = line.rstrip("\n")
+        for kind, pattern in PATTERNS:
+            match = pattern.match(line)
+            if match is None:
+                continue
+            fields = match.groupdict()
+            if kind == "folder":
+                set_status(fields["sku"], "checked")
+            elif kind in ("skipped", "failed"):
+                set_status(fields["sku"], kind, fields["detail"])
+            elif kind == "summary":
+                set_status(fields["sku"], "failed" if fields["status"] == "FAILED" else "checked", fields["detail"])
+            elif kind == "unchanged_folders":
+                unchanged_folders += int(fields["count"])
+            elif kind in ("downloaded", "download_failed"):
+                sku = dropbox_sku(fields["path"])
+                files.append((sku, fields["path"], kind, fields.get("detail")))
+                if kind == "download_failed":
+                    set_status(sku, "failed", fields["detail"])
+            else:
+                sku = remote_sku(fields["path"])
+                files.append((sku, fields["path"], kind, fields.get("detail")))
+                set_status(sku, "failed" if kind == "upload_failed" else kind, fields.get("detail"))
+            break
+    return folders, files, unchanged_folders
+
+
+class ReportIndex:
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        with self._conn:
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS runs (
+                    id INTEGER PRIMARY KEY,
+                    run_date TEXT NOT NULL UNIQUE,
+                    report TEXT NOT NULL,
+                    folders_checked INTEGER NOT NULL,
+                    folders_published INTEGER NOT NULL,
+                    folders_failed INTEGER NOT NULL,
+                    folders_unchanged INTEGER NOT NULL,
+                    files_published INTEGER NOT NULL,
+                    ingested_at TEXT NOT NULL
+                );
+                -- Most rows repeat a handful of skip reasons, so details are stored once each.
+                CREATE TABLE IF NOT EXISTS details (
+                    id INTEGER PRIMARY KEY,
+                    text TEXT NOT NULL UNIQUE
+                );
+                -- ~1200 folders per run: keyed by SKU for history lookups, by run for date/status ones.
+                CREATE TABLE IF NOT EXISTS folders (
+                    sku TEXT NOT NULL COLLATE NOCASE,
+                    run_id INTEGER NOT NULL REFERENCES runs (id),
+                    status TEXT NOT NULL,
+                    detail_id INTEGER REFERENCES details (id),
+                    PRIMARY KEY (sku, run_id)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS folders_run ON folders (run_id, status);
+                CREATE TABLE IF NOT EXISTS files (
+                    run_id INTEGER NOT NULL REFERENCES runs (id),
+                    sku TEXT NOT NULL COLLATE NOCASE,
+                    path TEXT NOT NULL,
+                    event TEXT NOT NULL,
+                    detail TEXT
+                );
+                CREATE INDEX IF NOT EXISTS files_sku ON files (sku, run_id);
+                CREATE INDEX IF NOT EXISTS files_run ON files (run_id);
+                """
+            )
+
+    def ingest(self, report_path):
+        """Index one report-YYYY-MM-DD.txt, replacing anything already held for that date."""
+        match = REPORT_NAME.search(os.path.basename(report_path))
+        if match is None:
+            raise ValueError(f"{report_path} is not named report-YYYY-MM-DD.txt")
+        run_date = match.group(1)
+        with open(report_path, encoding="utf-8", errors="replace") as f:
+            folders, files, unchanged_folders = parse_report(f)
+
+        statuses = [status for status, _ in folders.values()]
+        with self._conn:
+            previous = self._conn.execute("SELECT id FROM runs WHERE run_date = ?", (run_date,)).fetchone()
+            if previous is not None:
+                for table in ("folders", "files"):
+                    self._conn.execute(f"DELETE FROM {table} WHERE run_id = ?", previous)
+                self._conn.execute("DELETE FROM runs WHERE id = ?", previous)
+            run_id = self._conn.execute(
+                """
+                INSERT INTO runs (run_date, report, folders_checked, folders_published, folders_failed,
+                                  folders_unchanged, files_published, ingested_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    run_date,
+                    os.path.basename(report_path),
+                    len(folders) + unchanged_folders,
+                    statuses.count("published"),
+                    statuses.count("failed"),
+                    statuses.count("unchanged") + unchanged_folders,
+                    sum(1 for _, _, event, _ in files if event == "published"),
+                    datetime.utcnow().isoformat(),
+                ),
+            ).lastrowid
+            self._conn.executemany(
+                "INSERT INTO folders VALUES (?, ?, ?, ?)",
+                [(sku, run_id, status, self._detail_id(detail)) for sku, (status, detail) in folders.items()],
+            )
+            self._conn.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                [(run_id, sku, path, event, detail) for sku, path, event, detail in files],
+            )
+        return run_date, len(folders), len(files)
+
+    def catch_up(self, reports_dir=REPORTS_DIR):
+        """Ingest every report-*.txt in reports_dir that is not indexed yet; returns how many."""
+        indexed = {report for report, in self._conn.execute("SELECT report FROM runs")}
+        paths = [
+            path for path in sorted(glob.glob(os.path.join(reports_dir, "report-*.txt")))
+            if os.path.basename(path) not in indexed
+        ]
+        for path in paths:
+            self.ingest(path)
+        return len(paths)
+
+    def _detail_id(self, detail):
+        if detail is None:
+            return None
+        self._conn.execute("INSERT OR IGNORE INTO details (text) VALUES (?)", (detail,))
+        return self._conn.execute("SELECT id FROM details WHERE text = ?", (detail,)).fetchone()[0]
+
+    def sku_history(self, sku):
+        return self._conn.execute(
+            """
+            SELECT run_date, status, text FROM folders
+            JOIN runs ON runs.id = run_id LEFT JOIN details ON details.id = detail_id
+            WHERE sku = ? ORDER BY run_date DESC
+            """,
+            (sku,),
+        ).fetchall()
+
+    def sku_files(self, sku):
+        return self._conn.execute(
+            "SELECT run_date, event, path FROM files JOIN runs ON runs.id = run_id WHERE sku = ? ORDER BY run_date DESC, path",
+            (sku,),
+        ).fetchall()
+
+    def folders(self, run_date=None, status=None, since=None):
+        query = """
+            SELECT run_date, sku, status, text FROM runs
+            JOIN folders ON run_id = runs.id LEFT JOIN details ON details.id = detail_id WHERE 1 = 1
+        """
+        params = []
+        if run_date:
+            query += " AND run_date = ?"
+            params.append(run_date)
+        if status:
+            query += " AND status = ?"
+            params.append(status)
+        if since:
+            query += " AND run_date >= ?"
+            params.append(since)
+        return self._conn.execute(query + " ORDER BY run_date DESC, sku", params).fetchall()
+
+    def runs(self):
+        return self._conn.execute(
+            """
+            SELECT run_date, report, folders_checked, folders_published, folders_failed, folders_unchanged, files_published
+            FROM runs ORDER BY run_date DESC
+            """
+        ).fetchall()
+
+    def compact(self):
+        self._conn.execute("VACUUM")
+
+    def close(self):
+        self._conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index and query the weekly reports.")
+    parser.add_argument("--db", default=INDEX_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill = commands.add_parser("backfill", help="index every report-*.txt in a directory")
+    backfill.add_argument("--reports", default=REPORTS_DIR)
+    ingest = commands.add_parser("ingest", help="index the given report(s)")
+    ingest.add_argument("reports", nargs="+")
+    sku = commands.add_parser("sku", help="run history of one SKU folder")
+    sku.add_argument("sku")
+    sku.add_argument("--files", action="store_true", help="list file events too")
+    date = commands.add_parser("date", help="folders of one run")
+    date.add_argument("run_date")
+    date.add_argument("--status", choices=sorted(STATUS_RANK))
+    status = commands.add_parser("status", help="folders with a status across runs")
+    status.add_argument("status", choices=sorted(STATUS_RANK))
+    status.add_argument("--since", metavar="YYYY-MM-DD")
+    commands.add_parser("runs", help="one line per indexed run")
+    args = parser.parse_args()
+
+    index = ReportIndex(args.db)
+    try:
+        if args.command in ("backfill", "ingest"):
+            paths = args.reports if args.command == "ingest" else sorted(glob.glob(os.path.join(args.reports, "report-*.txt")))
+            for path in paths:
+                run_date, folders, files = index.ingest(path)
+                print(f"Indexed {path}: {folders} folder(s), {files} file event(s).")
+            if args.command == "backfill":
+                index.compact()
+            return
+        added = index.catch_up()
+        if added:
+            print(f"Indexed {added} new report(s) from {REPORTS_DIR}/.")
+        if args.command == "sku":
+            rows = index.sku_history(args.sku)
+            if not rows:
+                print(f"No runs mention {args.sku}.")
+            for run_date, status, detail in rows:
+                print(f"{run_date}  {status:<9} {detail or ''}".rstrip())
+            if args.files:
+                for run_date, event, path in index.sku_files(args.sku):
+                    print(f"{run_date}  {event:<15} {path}")
+        elif args.command in ("date", "status"):
+            run_date = args.run_date if args.command == "date" else None
+            since = args.since if args.command == "status" else None
+            for run_date, sku_name, status, detail in index.folders(run_date, args.status, since):
+                print(f"{run_date}  {status:<9} {sku_name}" + (f": {detail}" if detail else ""))
+        else:
+            for run_date, report, checked, published, failed, unchanged, files in index.runs():
+                print(
+                    f"{run_date}  {checked:>5} checked, {published:>3} published, {failed:>3} failed, "
+                    f"{unchanged:>5} unchanged, {files:>4} file(s) published  ({report})"
+                )
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Structured per-stage metrics for a weekly run.
+
+The reports/report-*.txt logs are free text with no timings or sizes. Every
+stage (listing, each download, STEPs 1-7, each FTP transfer) records an event
+here; once open() has been called, each event is also appended as one JSON
+line to the metrics file:
+
+    {"ts": "...", "stage": "step2_rembg", "folder": "005-GB", "image": "W005-GB-01.JPG",
+     "duration": 1.84, "bytes_in": null, "bytes_out": null, "width": 6000, "height": 4000,
+     "rss_mb": 1450.2, "peak_rss_mb": 1893.0, "status": "ok"}
+
+summary_table() aggregates the events per stage for the end of the report,
+and startup_table() breaks down where the time before (and outside) the
+folder work went: interpreter start, imports, listing and - only when a
+folder needs it - the image/segmentation stack (see timed_import()).
+"""
+import importlib
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+def reset_peak_rss():
+    """Reset the kernel's peak-RSS counter (Linux); returns False where unsupported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _proc_status_mb(key):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(key):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def rss_mb():
+    return _proc_status_mb("VmRSS:")
+
+
+def process_age():
+    """Seconds since this process was started (Linux), or None where unsupported."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_mb():
+    peak = _proc_status_mb("VmHWM:")
+    if peak is None:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return peak
+
+
+class RunMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._file = None
+        self.path = None
+        self.stages = {}
+        self.phases = {}
+
+    def open(self, path):
+        """Start writing events as JSON lines to path (appends)."""
+        with self._lock:
+            self.path = path
+            self._file = open(path, "a")
+
+    def event(self, stage, duration=None, status="ok", **fields):
+        record = {
+            "ts": datetime.utcnow().isoformat(),
+            "stage": stage,
+            "duration": round(duration, 4) if duration is not None else None,
+            "rss_mb": rss_mb(),
+            "peak_rss_mb": peak_rss_mb(),
+            "status": status,
+        }
+        record.update(fields)
+        with self._lock:
+            totals = self.stages.setdefault(stage, {"count": 0, "errors": 0, "duration": 0.0, "bytes_in": 0, "bytes_out": 0, "peak_rss_mb": 0.0})
+            totals["count"] += 1
+            totals["errors"] += status != "ok"
+            totals["duration"] += duration or 0.0
+            totals["bytes_in"] += fields.get("bytes_in") or 0
+            totals["bytes_out"] += fields.get("bytes_out") or 0
+            totals["peak_rss_mb"] = max(totals["peak_rss_mb"], record["peak_rss_mb"] or 0.0)
+            if self._file is not None:
+                self._file.write(json.dumps(record, default=str) + "\n")
+                self._file.flush()
+        return record
+
+    @contextmanager
+    def timed(self, stage, **fields):
+        """
+        Time the block as one event. The yielded dict can be filled in with
+        bytes_in/bytes_out/width/height (or anything else) before it ends.
+        """
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            yield fields
+        except Exception as e:
+            status = "error"
+            fields["error"] = str(e)
+            raise
+        finally:
+            self.event(stage, duration=time.perf_counter() - start, status=status, **fields)
+
+    def phase(self, name, seconds):
+        """Add seconds to a startup phase (see startup_table)."""
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def startup_table(self):
+        lines = ["=== Startup ==="]
+        with self._lock:
+            phases = list(self.phases.items())
+        for name, seconds in phases:
+            lines.append(f"{name:<24} {seconds:8.2f}s")
+        lines.append(f"{'total':<24} {sum(seconds for _, seconds in phases):8.2f}s")
+        return "\n".join(lines)
+
+    def summary_table(self):
+        lines = [
+            "=== Stage metrics ===",
+            f"{'stage':<24} {'count':>6} {'errors':>6} {'total s':>9} {'mean s':>8} {'MB in':>9} {'MB out':>9} {'peak RSS MB':>12}",
+        ]
+        with self._lock:
+            stages = sorted(self.stages.items())
+        for stage, t in stages:
+            mean = t["duration"] / t["count"] if t["count"] else 0.0
+            lines.append(
+                f"{stage:<24} {t['count']:>6} {t['errors']:>6} {t['duration']:9.1f} {mean:8.2f} "
+                f"{t['bytes_in'] / (1024 * 1024):9.1f} {t['bytes_out'] / (1024 * 1024):9.1f} {t['peak_rss_mb']:12.0f}"
+            )
+        if self.path:
+            lines.append(f"Events written to {self.path}.")
+        return "\n".join(lines)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# One recorder per process; image_pipeline and the scripts all report into it.
+metrics = RunMetrics()
+
+_import_lock = threading.Lock()
+
+
+def timed_import(name, phase):
+    """
+    Import module name the first time it is needed, recording how long that
+    took as a startup phase. The scripts load the image stack (PIL, rembg,
+    onnxruntime, numpy) this way so a week with nothing to process never does.
+    """
+    with _import_lock:
+        if name in sys.modules:
+            return sys.modules[name]
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+    elapsed = time.perf_counter() - start
+    metrics.phase(phase, elapsed)
+    metrics.event("import", duration=elapsed, module=name)
+    return module
@@ -1,15 +1,27 @@
+import time
+STARTED = time.perf_counter()  # for the startup breakdown, see record_startup()
 import os
 # from dotenv import load_dotenv
 # load_dotenv()
 import io
-import time
-import ftplib
+import queue
+import sys
+import threading
 import dropbox
 import re
-from rembg import remove
-from PIL import Image
+import shutil
 from datetime import datetime
-from dropbox.files import SharedLink, FileMetadata, FolderMetadata
+from contextlib import contextmanager
+from downloader import Downloader
+from ftp_publish import FTPPool, FTPPublisher
+from dropbox_listing import FolderListing
+from manifest import SOURCE_MAX_ATTEMPTS, Manifest
+# PIL, rembg and onnxruntime (image_pipeline, bg_removal) are not imported here. main() imports them,
+# through timed_import(), once the listing yields at least one target folder, even if download_folder()
+# then skips every one; with no target folders they are never loaded. The import is not per folder:
+# it has to happen on the main thread, before the pipeline starts (see main()).
+from run_metrics import metrics, process_age, timed_import
+IMPORTED = time.perf_counter()
 
 # === Dropbox Setup ===
 # Move credentials to environment variables for safety.
@@ -36,6 +48,9 @@ dbx = dropbox.Dropbox(
 # === Shared Folder Link ===
 SHARED_LINK = os.environ.get("DROPBOX_SHARED_LINK") or "https://www.dropbox.com/scl/fo/x5wa53hnnfjrru13wh1j6/h?rlkey=h9r8xsjmq43vx43ofjqq0henb"
 
+# Shared by every folder worker so the number of concurrent transfers stays bounded.
+downloader = Downloader(dbx, SHARED_LINK)
+
 # === FTP Setup ===
 # FTP_HOST = "ipwstock.com"
 # FTP_USER = "u307603549"
@@ -45,10 +60,32 @@ FTP_USER = os.environ["FTP_USER"]
 FTP_PASS = os.environ["FTP_PASS"]
 REMOTE_BASE_PATH = '/domains/ipwstock.com/public_html/public/dropbox/'
 
+# === Parallelism ===
+# Number of SKU folders in the image-processing stage at once (see Pipeline).
+# Folders are independent, so several can run rembg side by side.
+# How many of their images are decoded at once is capped by MEMORY_BUDGET_MB (see memory_budget.py).
+FOLDER_WORKERS = int(os.environ.get("FOLDER_WORKERS", str(os.cpu_count() or 1)))
+
 
 # ----------------------------
 # State tracking
 # ----------------------------
+# Dropbox listing + cursors, cached between runs alongside .last_run.txt.
+LIST_STATE_FILE = ".list_state.json"
+# Per-stage JSON-lines events (see run_metrics); the workflow files it under reports/.
+METRICS_FILE = os.environ.get("METRICS_FILE", "metrics.jsonl")
+# Sources already published, by path + Dropbox content_hash (see manifest.py).
+manifest = Manifest(".manifest.sqlite")
+# Logged-in connections kept for the whole run and shared by all folders.
+publisher = FTPPublisher(FTPPool(FTP_HOST, FTP_USER, FTP_PASS), manifest=manifest)
+SET_UP = time.perf_counter()
+
+
+def image_stack():
+    """image_pipeline, imported on first use (see timed_import)."""
+    return timed_import("image_pipeline", "image stack import")
+
+
 def get_last_run_time():
     if os.path.exists(".last_run.txt"):
         with open(".last_run.txt", "r") as f:
@@ -63,297 +100,470 @@ def update_last_run_time():
 # ----------------------------
 # Processing pipeline
 # ----------------------------
-def process_folder(base_folder, folder):
+def process_folder(base_folder, folder, hero=None):
     folder_path = os.path.join(base_folder, folder)
     os.makedirs(folder_path, exist_ok=True)
 
-     # === STEP 1: Resize to 6000x4000 & white background ===
-    file_list = os.listdir(folder_path)
-    for file in file_list:
-        image_path = os.path.join(folder_path, file)
-        if not os.path.isfile(image_path):
-            continue
-        try:
-            original_image = Image.open(image_path)
-        except:
-            continue
+    # === STEP 1-6: Build the main .webp, PNG and 400x270 images in memory ===
+    # hero is None when the published PNG's hero image is unchanged (see download_folder).
+    # The source file names actually processed; one that failed to decode is not among them.
+    return image_stack().build_derivatives(folder_path, folder, hero=hero, render_png=hero is not None)
 
-        target_height, target_width = 4000, 6000
-        original_width, original_height = original_image.size
-        aspect_ratio = original_width / original_height
 
-        if aspect_ratio > target_width / target_height:
-            desired_width = target_width
-            desired_height = int(target_width / aspect_ratio)
-        else:
-            desired_height = target_height
-            desired_width = int(target_height * aspect_ratio)
-
-        resized_image = original_image.resize((desired_width, desired_height), Image.LANCZOS)
-
-        crop_left = (desired_width - target_width) // 2
-        crop_top = (desired_height - target_height) // 2
-        crop_right = crop_left + target_width
-        crop_bottom = crop_top + target_height
-
-        cropped_image = resized_image.crop((crop_left, crop_top, crop_right, crop_bottom))
-
-        background_image = Image.new('RGB', (target_width, target_height), (255, 255, 255))
-        paste_left = (target_width - cropped_image.width) // 2
-        paste_top = (target_height - cropped_image.height) // 2
-        background_image.paste(cropped_image, (paste_left, paste_top))
-        background_image.save(image_path)
-        print(f"{image_path} resized to 6000x4000 with white background.")
-
-    # === STEP 2: Remove background & convert to .webp ===
-    image_list = os.listdir(folder_path)
-    for image_file in image_list:
-        file_path = os.path.join(folder_path, image_file)
-        if not os.path.isfile(file_path):
-            continue
-        try:
-            img = Image.open(file_path)
-        except:
-            continue
-        remove_bg = remove(img)
-        webp_path = file_path + '.webp'
-        remove_bg.save(webp_path, format="webp", optimize=True, quality=10)
-        print(f"{image_file} background removed & saved as webp.")
-
-    # === STEP 3: Clean up original images ===
-    rm_image_list = os.listdir(folder_path)
-    for rm_image in rm_image_list:
-        rm_file_path = os.path.join(folder_path, rm_image)
-        time.sleep(1)
-        if rm_image.endswith('.webp'):
-            filename, extension = os.path.splitext(rm_file_path)
-            new_file_path = filename.split(".")[0] + extension
-            os.rename(rm_file_path, new_file_path)
-        elif rm_image.lower().endswith(('.jpg', '.png')):
-            os.remove(rm_file_path)
-            print(f"{rm_image} removed.")
-
-    # === STEP 4: Create PNG folder & save 500x500 PNG ===
+def publish_folder(base_folder, folder):
+    folder_path = os.path.join(base_folder, folder)
     png_folder = os.path.join(folder_path, "PNG")
-    if not os.path.exists(png_folder):
-        os.mkdir(png_folder)
-    for file in os.listdir(folder_path):
-        if file not in ("PNG", "images") and file.lower().endswith('.webp'):
-            image_path = os.path.join(folder_path, file)
-            img = Image.open(image_path)
-            target_height, target_width = 500, 500
-            original_width, original_height = img.size
-            aspect_ratio = original_width / original_height
-            if aspect_ratio > target_width / target_height:
-                desired_width = target_width
-                desired_height = int(target_width / aspect_ratio)
-            else:
-                desired_height = target_height
-                desired_width = int(target_height * aspect_ratio)
-            resized_image = img.resize((desired_width, desired_height), Image.LANCZOS)
-            crop_left = (desired_width - target_width) // 2
-            crop_top = (desired_height - target_height) // 2
-            crop_right = crop_left + target_width
-            crop_bottom = crop_top + target_height
-            cropped_image = resized_image.crop((crop_left, crop_top, crop_right, crop_bottom))
-            background_image = Image.new('RGB', (target_width, target_height), (255, 255, 255))
-            paste_left = (target_width - cropped_image.width) // 2
-            paste_top = (target_height - cropped_image.height) // 2
-            background_image.paste(cropped_image, (paste_left, paste_top))
-            png_path = os.path.join(png_folder, folder + '.png')
-            background_image.save(png_path, format="png", optimize=True, quality=10)
-            print(f"{image_path} saved as 500x500 PNG.")
-
-    # === STEP 5: Create images folder & save 400x270 images ===
     images_folder = os.path.join(folder_path, "images")
-    if not os.path.exists(images_folder):
-        os.mkdir(images_folder)
-    for file in os.listdir(folder_path):
-        if file not in ("PNG", "images") and file.lower().endswith('.webp'):
-            image_path = os.path.join(folder_path, file)
-            img = Image.open(image_path)
-            resized_image = img.resize((400, 270), Image.LANCZOS)
-            save_path = os.path.join(images_folder, file)
-            resized_image.save(save_path)
-            print(f"{image_path} resized to 400x270 in images folder.")
-
-    # === STEP 6: Remove background again in /images & set white background ===
-    for image_file in os.listdir(images_folder):
-        if image_file.endswith('.webp'):
-            input_image_path = os.path.join(images_folder, image_file)
-            with open(input_image_path, "rb") as f:
-                image_data = f.read()
-            result = remove(image_data)
-            image = Image.open(io.BytesIO(result)).convert("RGBA")
-            background = Image.new('RGBA', image.size, (255, 255, 255, 255))
-            background.paste(image, (0, 0), image)
-            background.save(input_image_path, format="WEBP")
-            print(f"{input_image_path} white background reapplied.")
 
     # === STEP 7: Store Image to hostinger account ===
-    ftp = ftplib.FTP(FTP_HOST, FTP_USER, FTP_PASS)
-    try:
-        ftp.cwd(REMOTE_BASE_PATH)
-    except Exception:
-        # try to create base path
-        try:
-            ftp.mkd(REMOTE_BASE_PATH)
-            ftp.cwd(REMOTE_BASE_PATH)
-        except Exception as e:
-            ftp.quit()
-            raise
-
+    # Uploads go through the run-wide connection pool (see ftp_publish); only files whose bytes changed are sent.
     remote_folder_path = os.path.join(REMOTE_BASE_PATH, folder).replace("\\", "/")
-    remote_folders = ftp.nlst()
-    if folder not in remote_folders:
+    for created in publisher.ensure_dirs([
+        REMOTE_BASE_PATH,
+        remote_folder_path,
+        f"{remote_folder_path}/images",
+        f"{remote_folder_path}/PNG",
+    ]):
+        print(f"'{created}' created on the remote server.")
+
+    jobs = [
+        (os.path.join(folder_path, x), f"{remote_folder_path}/{x}")
+        for x in sorted(os.listdir(folder_path)) if x.lower().endswith('.webp')
+    ]
+    for local_path, remote_path in ((images_folder, f"{remote_folder_path}/images"), (png_folder, f"{remote_folder_path}/PNG")):
+        if os.path.exists(local_path):
+            jobs += [
+                (os.path.join(local_path, x), f"{remote_path}/{x}")
+                for x in sorted(os.listdir(local_path)) if os.path.isfile(os.path.join(local_path, x)) and not x.endswith(".part")
+            ]
+
+    failed = 0
+    for local_file, remote_file, status, size, seconds, error in publisher.publish(jobs):
+        if status == "failed":
+            print(f"Failed to upload {remote_file}: {error}")
+            failed += 1
+        elif status == "unchanged":
+            print(f"Unchanged, not re-sent: {remote_file}")
+        else:
+            print(f"Uploaded/Updated: {remote_file} ({size / 1024:.0f} KB in {seconds:.1f}s)")
+    if failed:
+        raise RuntimeError(f"{failed} of {len(jobs)} upload(s) failed for {folder}")
+
+
+# ----------------------------
+# Pipeline
+# ----------------------------
+# Folders flow through three stages joined by bounded queues, so folder N+1
+# downloads while folder N is segmented and folder N-1 uploads:
+#
+#   download (1 thread) -> process (FOLDER_WORKERS threads) -> publish (1 thread)
+#
+# Within a folder, downloads and uploads are already parallel (downloader,
+# ftp_publish). A full queue blocks the stage feeding it, which bounds how many
+# downloaded-but-unprocessed folders sit on disk and in flight.
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", "2"))
+_DONE = object()
+
+
+class FolderOutput:
+    """
+    sys.stdout stand-in used while the pipeline runs. Prints made inside
+    capture(log) go to that folder's log buffer, which travels with the folder
+    from stage to stage and is written out in one piece when the folder is
+    finished, so the report keeps every folder's lines together.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is not None:
+            return buffer.write(text)
+        with self._lock:
+            return self._stream.write(text)
+
+    def flush(self):
+        if getattr(self._local, "buffer", None) is None:
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    @contextmanager
+    def capture(self, log):
+        self._local.buffer = log
         try:
-            ftp.mkd(remote_folder_path)
-            print(f"'{folder}' created on the remote server.")
-        except Exception:
-            pass
+            yield
+        finally:
+            self._local.buffer = None
+
+    def emit(self, log):
+        with self._lock:
+            self._stream.write(log.getvalue())
+            self._stream.flush()
+
+
+class FolderJob:
+    def __init__(self, index, folder):
+        self.index = index
+        self.folder = folder
+        self.log = io.StringIO()
+        self.sources = None
+        self.downloaded = None
+        self.hero = None
+        self.stage = None
+        self.missing = []
+
+
+def run_folders(target_folders, local_downloads):
+    """Run every folder through the pipeline; returns (name, status, detail) in target order."""
+    to_process = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    to_publish = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    results = {}
+    output = FolderOutput(sys.stdout)
+
+    def finish(job, status, detail=None):
+        results[job.index] = (job.folder.name, status, detail)
+        output.emit(job.log)
+
+    def stage(job, name, action):
+        """Run action() in job's log; on failure record the folder as failed and return False."""
+        with output.capture(job.log):
+            try:
+                with metrics.timed(f"folder_{name}", folder=job.folder.name):
+                    action()
+                return True
+            except Exception as e:
+                print(f"Error processing {job.folder.name}: {e}")
+                error = str(e)
+        finish(job, "failed", error)
+        return False
+
+    def fail(job, error):
+        """Record job as failed after something escaped stage() itself (its log may be lost)."""
+        results.setdefault(job.index, (job.folder.name, "failed", str(error)))
 
-    def upload_folder(local_path, remote_path):
+    def download_stage():
         try:
-            ftp.mkd(remote_path)
-        except ftplib.error_perm as e:
-            # 550 means folder exists on many servers
-            if not str(e).startswith("550"):
-                print(f"FTP mkdir error: {e}")
-        for filename in os.listdir(local_path):
-            local_file = os.path.join(local_path, filename)
-            remote_file = f"{remote_path}/{filename}"
-            if os.path.isfile(local_file):
-                # remove remote file if it exists, ignore permission errors
-                try:
-                    ftp.delete(remote_file)
-                    print(f"Removed remote {remote_file} (will replace).")
-                except ftplib.error_perm:
-                    pass
-                with open(local_file, 'rb') as f:
-                    ftp.storbinary(f"STOR {remote_file}", f)
-                print(f"Uploaded/Updated: {remote_file}")
-
-    # Upload main .webp (always replace on remote)
-    main_webp_list = [x for x in os.listdir(folder_path) if x.lower().endswith('.webp')]
-    for webp_image in main_webp_list:
-        local_image_path = os.path.join(folder_path, webp_image)
-        server_path = f"{remote_folder_path}/{webp_image}"
+            for index, folder in enumerate(target_folders):
+                job = FolderJob(index, folder)
+
+                def download():
+                    result = download_folder(folder, local_downloads)
+                    if result is None:
+                        manifest.forget_folder(folder.name)
+                        # Nothing of a skipped folder is kept on disk (or in the workflow cache).
+                        shutil.rmtree(os.path.join(local_downloads, folder.name), ignore_errors=True)
+                    else:
+                        job.sources, job.downloaded, job.hero, job.stage = result
+
+                if not stage(job, "download", download):
+                    continue
+                if job.downloaded is None:
+                    finish(job, "skipped")
+                    continue
+                to_process.put(job)
+        finally:
+            for _ in range(FOLDER_WORKERS):
+                to_process.put(_DONE)
+
+    def process_stage():
         try:
-            ftp.delete(server_path)
-            print(f"Removed old remote {server_path}.")
-        except ftplib.error_perm:
-            pass
-        with open(local_image_path, 'rb') as f:
-            ftp.storbinary(f"STOR {server_path}", f)
-        print(f"'{server_path}' transferred to the remote server.")
+            while True:
+                job = to_process.get()
+                if job is _DONE:
+                    break
+
+                def process():
+                    processed = set(process_folder(local_downloads, job.folder.name, job.hero))
+                    # Only what was processed gets published; the rest stays owed (see manifest.finish_folder).
+                    job.downloaded = [source for source in job.downloaded if os.path.basename(source[0]) in processed]
+                    manifest.record_stage(job.folder.name, "processed", job.sources, job.hero, done=job.downloaded)
+
+                # A folder journaled as processed by an interrupted run goes straight to publishing.
+                try:
+                    ready = job.stage == "processed" or stage(job, "process", process)
+                except Exception as e:
+                    # Fails this folder only: a dead worker would leave the download stage blocked on put().
+                    fail(job, e)
+                    continue
+                if ready:
+                    to_publish.put(job)
+        finally:
+            to_publish.put(_DONE)
+
+    def publish_stage():
+        remaining = FOLDER_WORKERS
+        while remaining:
+            job = to_publish.get()
+            if job is _DONE:
+                remaining -= 1
+                continue
 
-    if os.path.exists(images_folder):
-        upload_folder(images_folder, f"{remote_folder_path}/images")
-    if os.path.exists(png_folder):
-        upload_folder(png_folder, f"{remote_folder_path}/PNG")
+            def publish():
+                publish_folder(local_downloads, job.folder.name)
+                job.missing, given_up = manifest.finish_folder(job.folder.name, job.downloaded, job.sources)
+                if job.missing:
+                    print(f"{len(job.missing)} image(s) in {job.folder.name} still pending; they are retried next run.")
+                if given_up:
+                    print(
+                        f"Giving up on {len(given_up)} image(s) in {job.folder.name} after {SOURCE_MAX_ATTEMPTS} failed run(s): "
+                        + ", ".join(os.path.basename(path) for path, _ in given_up)
+                    )
+                # Only unfinished folders are kept on disk (and in the workflow cache) for a resume.
+                shutil.rmtree(os.path.join(local_downloads, job.folder.name), ignore_errors=True)
 
-    ftp.quit()
+            try:
+                if stage(job, "publish", publish):
+                    pending = f", {len(job.missing)} pending" if job.missing else ""
+                    finish(job, "processed", f"{len(job.downloaded)} image(s){pending}")
+            except Exception as e:
+                # Fails this folder only: the thread keeps draining to_publish, or the process stage
+                # would block on put() into the full queue and run_folders() would never return.
+                fail(job, e)
+
+    sys.stdout = output
+    try:
+        threads = [threading.Thread(target=download_stage, name="download-stage")]
+        threads += [threading.Thread(target=process_stage, name=f"process-stage-{i}") for i in range(FOLDER_WORKERS)]
+        threads += [threading.Thread(target=publish_stage, name="publish-stage")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.stdout = output._stream
+    return [results[i] for i in sorted(results)]
+
+
+def print_summary(results):
+    processed = [r for r in results if r[1] == "processed"]
+    failed = [r for r in results if r[1] == "failed"]
+    skipped = len(results) - len(processed) - len(failed)
+    print("=== Folder summary ===")
+    for name, status, detail in processed + failed:
+        print(f"{status.upper():<9} {name}" + (f": {detail}" if detail else ""))
+    print(f"{len(processed)} processed, {len(failed)} failed, {skipped} skipped ({FOLDER_WORKERS} process worker(s)).")
 
 
 # ----------------------------
 # Main
 # ----------------------------
-def main():
-    last_run = get_last_run_time()
-    local_downloads = "downloads"
-    os.makedirs(local_downloads, exist_ok=True)
-
-    # Create SharedLink object
-    link = SharedLink(url=SHARED_LINK)
-
-    # List root contents of the shared link
-    result = dbx.files_list_folder(path="", shared_link=link)
-    entries = result.entries
-    while result.has_more:
-        result = dbx.files_list_folder_continue(result.cursor)
-        entries.extend(result.entries)
-
+def list_target_folders(listing, changed):
     # Only top-level folders with "-" in the name
-    target_folders = [
-        e for e in entries
+    names = [
+        name for name in listing.folders
         if (
-            isinstance(e, dropbox.files.FolderMetadata)
-            and "-" in e.name
-            and "disc" not in e.name.lower()           # exclude "Discontinue" variants
-            and "undone" not in e.name.lower()         # exclude "Undone" variants
-            and "single drill" not in e.name.lower()   # exclude "Single Drill" variants
-            and "828-1" not in e.name.lower()          # exclude "828-1" variants
-            and not any("  " in part for part in e.name.split("-"))  # exclude extra spaces between segments
+            "-" in name
+            and "disc" not in name.lower()           # exclude "Discontinue" variants
+            and "undone" not in name.lower()         # exclude "Undone" variants
+            and "single drill" not in name.lower()   # exclude "Single Drill" variants
+            and "828-1" not in name.lower()          # exclude "828-1" variants
+            and not any("  " in part for part in name.split("-"))  # exclude extra spaces between segments
+        )
+    ]
+    # A journaled or failed folder that has since been deleted from Dropbox is never coming back.
+    for name in manifest.journaled_folders() - set(listing.folders):
+        print(f"Dropping the journal of {name}: the folder is no longer in Dropbox.")
+        manifest.forget_folder(name)
+    listing.failed &= set(listing.folders)
+    if changed is not None:
+        # Folders an interrupted run left unfinished, or the last run failed on, are picked up
+        # again even if Dropbox shows no change: the saved cursors have already moved past it.
+        unfinished = manifest.journaled_folders() - set(changed)
+        if unfinished:
+            print(f"Resuming {len(unfinished)} unfinished folder(s) from an earlier run.")
+        retry = listing.failed - set(changed) - unfinished
+        if retry:
+            print(f"Retrying {len(retry)} folder(s) that failed on the last run.")
+        changed = set(changed) | unfinished | retry
+        unchanged = [name for name in names if name not in changed]
+        names = [name for name in names if name in changed]
+        print(f"Skipping {len(unchanged)} folder(s) with no changes since the last run.")
+    return [listing.folder(name) for name in names]
+
+
+def download_folder(folder, local_downloads):
+    """
+    Pick the folder's eligible images and download them. Returns every
+    (dropbox_path, content_hash) pair the folder owes this run, the pairs
+    downloaded (or processed), the image to render the folder PNG from (None
+    to keep the published one) and the last stage done ("downloaded", or
+    "processed" when resuming), or None if the folder is skipped.
+    """
+    print(f"Processing folder: {folder.name}")
+    # Folder contents come from the saved listing (see dropbox_listing), not a fresh files_list_folder call.
+    folder_entries = folder.files
+
+    # Only .jpg and .png files that end with a numeric suffix like "-04", "_05", etc.
+    numeric_suffix_re = re.compile(r".*[-_]\d+$")
+    files_to_download = [
+        f for f in folder_entries
+        if (
+            f.name.lower().endswith((".jpg", ".png", ".jpeg"))
+            and numeric_suffix_re.match(os.path.splitext(f.name)[0].lower())
         )
     ]
 
-    for folder in target_folders:
-        print(f"Processing folder: {folder.name}")
-        # SharedLink object just needs the URL
-        link = SharedLink(url=SHARED_LINK)
+    # local folder, created only once the folder is actually downloaded
+    local_folder_path = os.path.join(local_downloads, folder.name)
 
-        # The path inside the shared link is "/" + folder name
-        folder_result = dbx.files_list_folder(
-            path="/" + folder.name,
-            shared_link=link
-        )
+    # download files into local folder
+    now = datetime.utcnow()
+    MIN_FILES = int(os.environ.get("MIN_FILES_TO_PROCESS", "3"))  # set to 5 via env if you prefer
 
-        folder_entries = folder_result.entries
-        while folder_result.has_more:
-            folder_result = dbx.files_list_folder_continue(folder_result.cursor)
-            folder_entries.extend(folder_result.entries)
-
-        # Only .jpg and .png files that end with a numeric suffix like "-04", "_05", etc.
-        numeric_suffix_re = re.compile(r".*[-_]\d+$")
-        files_to_download = [
-            f for f in folder_entries
-            if (
-                isinstance(f, dropbox.files.FileMetadata)
-                and f.name.lower().endswith((".jpg", ".png", ".jpeg"))
-                and numeric_suffix_re.match(os.path.splitext(f.name)[0].lower())
-            )
-        ]
-
-        # prepare local folder
-        local_folder_path = os.path.join(local_downloads, folder.name)
-        os.makedirs(local_folder_path, exist_ok=True)
-
-        # download files into local folder
-        now = datetime.utcnow()
-        MIN_FILES = int(os.environ.get("MIN_FILES_TO_PROCESS", "3"))  # set to 5 via env if you prefer
-
-        # filter files by timestamp (only current month)
-        eligible_files = []
-        for f in files_to_download:
-            file_ts = getattr(f, "server_modified", None) or getattr(f, "client_modified", None)
-            if file_ts is None:
-                print(f"Skipping {f.name}: no timestamp available on metadata.")
-                continue
-            if file_ts.year == now.year and file_ts.month == now.month:
-                eligible_files.append(f)
+    # Images an earlier run owed this folder (failed downloads, undecodable sources) stay
+    # eligible whatever their month, until they are published (see manifest.finish_folder).
+    journaled = manifest.folder_stage(folder.name)
+    pending = {path.lower() for path, _ in journaled[1]} if journaled is not None else set()
 
-        if not eligible_files:
-            print(f"Skipping folder {folder.name}: no images from current month ({now.strftime('%Y-%m')}).")
+    # filter files by timestamp (only current month)
+    eligible_files = []
+    for f in files_to_download:
+        if ("/" + folder.name + "/" + f.name).lower() in pending:
+            eligible_files.append(f)
+            continue
+        file_ts = getattr(f, "server_modified", None) or getattr(f, "client_modified", None)
+        if file_ts is None:
+            print(f"Skipping {f.name}: no timestamp available on metadata.")
             continue
-        if len(eligible_files) < MIN_FILES:
-            print(f"Skipping folder {folder.name}: only {len(eligible_files)} file(s) from current month (min {MIN_FILES}).")
+        if file_ts.year == now.year and file_ts.month == now.month:
+            eligible_files.append(f)
+
+    if not eligible_files:
+        print(f"Skipping folder {folder.name}: no images from current month ({now.strftime('%Y-%m')}).")
+        return None
+    if len(eligible_files) < MIN_FILES and not pending:
+        print(f"Skipping folder {folder.name}: only {len(eligible_files)} file(s) from current month (min {MIN_FILES}).")
+        return None
+
+    # skip images whose bytes were already processed and published on an earlier run
+    new_files = [
+        f for f in eligible_files
+        if not manifest.is_published("/" + folder.name + "/" + f.name, f.content_hash)
+    ]
+    if not new_files:
+        print(f"Skipping folder {folder.name}: all {len(eligible_files)} image(s) already published.")
+        return None
+    if len(new_files) < len(eligible_files):
+        print(f"{len(eligible_files) - len(new_files)} image(s) in {folder.name} unchanged since last publish.")
+
+    # skip images given up on after manifest.SOURCE_MAX_ATTEMPTS runs, until their bytes change
+    given_up = [f for f in new_files if manifest.has_failed("/" + folder.name + "/" + f.name, f.content_hash)]
+    if given_up:
+        print(f"Skipping {len(given_up)} image(s) in {folder.name} that failed on earlier runs: {', '.join(f.name for f in given_up)}")
+        new_files = [f for f in new_files if f not in given_up]
+        if not new_files:
+            print(f"Skipping folder {folder.name}: no other image(s) to process.")
+            return None
+
+    content_hashes = {"/" + folder.name + "/" + f.name: f.content_hash for f in new_files}
+
+    os.makedirs(local_folder_path, exist_ok=True)
+
+    # Resume where an interrupted run stopped, if it was working on exactly these sources
+    # and left their files behind (see manifest.folder_stage).
+    if journaled is not None and journaled[0] in ("downloaded", "processed"):
+        stage, sources, done, hero = journaled
+        if stage == "processed":
+            ready = any(x.lower().endswith(".webp") for x in os.listdir(local_folder_path))
+        else:
+            ready = all(os.path.exists(os.path.join(local_folder_path, os.path.basename(p))) for p, _ in done)
+        if sorted(sources) == sorted(content_hashes.items()) and done and ready:
+            print(f"Resuming {folder.name}: {len(done)} of {len(sources)} image(s) already {stage} by an earlier run.")
+            return sources, done, hero, stage
+
+    # Anything left in the folder is from an unfinished run on other sources; start clean.
+    if os.listdir(local_folder_path):
+        print(f"Clearing leftovers of an earlier run in {local_folder_path}.")
+        shutil.rmtree(local_folder_path)
+        os.makedirs(local_folder_path)
+
+    jobs = [(dropbox_path, os.path.join(local_folder_path, os.path.basename(dropbox_path))) for dropbox_path in content_hashes]
+    downloaded = []
+    for dropbox_path, local_path, size, seconds, attempts, error in downloader.download(jobs):
+        if error is not None:
+            print(f"Failed to download {dropbox_path}: {error}")
             continue
+        retried = f", {attempts} attempts" if attempts > 1 else ""
+        print(f"Downloaded {dropbox_path} -> {local_path} ({size / 1024:.0f} KB in {seconds:.1f}s{retried})")
+        downloaded.append((dropbox_path, content_hashes[dropbox_path]))
+    if not downloaded:
+        # Journaled so the images are still owed next run, even once the month has turned.
+        manifest.record_stage(folder.name, "download_failed", content_hashes.items(), None, done=[])
+        raise RuntimeError(f"none of {len(jobs)} image(s) could be downloaded")
+
+    # The folder PNG comes from the hero image (see image_pipeline.select_hero). When only
+    # other images changed this run and the hero is already published, its PNG is left as is.
+    select_hero = image_stack().select_hero
+    hero_name = select_hero([f.name for f in files_to_download])
+    hero = next(f for f in files_to_download if f.name == hero_name)
+    if hero in new_files:
+        png_hero = hero.name
+    elif manifest.is_published("/" + folder.name + "/" + hero.name, hero.content_hash):
+        png_hero = None
+        print(f"Hero image {hero.name} unchanged; keeping the published PNG for {folder.name}.")
+    else:
+        png_hero = select_hero([f.name for f in new_files])
+    manifest.record_stage(folder.name, "downloaded", content_hashes.items(), png_hero, done=downloaded)
+    return sorted(content_hashes.items()), downloaded, png_hero, "downloaded"
+
+
+def record_startup():
+    """Startup phases up to main(): interpreter start, module imports, client setup."""
+    age = process_age()
+    if age is not None:
+        metrics.phase("interpreter", max(0.0, age - (time.perf_counter() - STARTED)))
+    metrics.phase("imports", IMPORTED - STARTED)
+    metrics.phase("setup", SET_UP - IMPORTED)
 
-        for f in eligible_files:
-            local_path = os.path.join(local_folder_path, f.name)
-            dropbox_path = "/" + folder.name + "/" + f.name
-            try:
-                md, res = dbx.sharing_get_shared_link_file(url=SHARED_LINK, path=dropbox_path)
-                with open(local_path, "wb") as out_f:
-                    out_f.write(res.content)
-                print(f"Downloaded {dropbox_path} -> {local_path}")
-            except Exception as e:
-                print(f"Failed to download {dropbox_path}: {e}")
 
-        # process the downloaded folder once
-        process_folder(local_downloads, folder.name)
+def main():
+    last_run = get_last_run_time()
+    local_downloads = "downloads"
+    os.makedirs(local_downloads, exist_ok=True)
 
+    metrics.open(METRICS_FILE)
+    record_startup()
+    listing_started = time.perf_counter()
+    listing = FolderListing.load(LIST_STATE_FILE, SHARED_LINK)
+    with metrics.timed("listing") as event:
+        changed = listing.refresh(dbx)
+        event["folders"] = len(listing.folders)
+    metrics.phase("listing", time.perf_counter() - listing_started)
+    target_folders = list_target_folders(listing, changed)
+    if target_folders:
+        # The image stack and rembg are imported here, on the main thread, before the pipeline starts:
+        # rembg (through pymatting) first imported on a worker thread keeps the interpreter from exiting.
+        image_stack()
+        timed_import("rembg", "rembg import")
+        # One rembg session per folder worker that will actually run, sized before any session exists
+        # so each gets its share of the cores (see BackgroundRemover.session_intra_op_threads).
+        image_stack().get_remover().pool_size = min(FOLDER_WORKERS, len(target_folders))
+    results = run_folders(target_folders, local_downloads)
+    print_summary(results)
+
+    # Save the cursor only after the folders are handled, so a crashed run sees the same changes again,
+    # together with the folders that failed, which the moved cursors would otherwise hide next week.
+    listing.failed = {name for name, status, _ in results if status == "failed"}
+    listing.save()
     update_last_run_time()
+    print(downloader.summary())
+    print(publisher.summary())
+    if "image_pipeline" in sys.modules:
+        print(image_stack().get_remover().summary())
+        print(image_stack().get_budget().summary())
+    else:
+        print("Image stack never loaded: no folder needed processing.")
+    print(metrics.startup_table())
+    print(metrics.summary_table())
+    downloader.close()
+    publisher.close()
+    manifest.close()
+    metrics.close()
 
 
 if __name__ == "__main__":
@@ -1,12 +1,16 @@
-import os
 import time
-import io
+STARTED = time.perf_counter()  # for the startup breakdown at the end of main()
+import os
+import sys
 import requests
-from rembg import remove
-from PIL import Image
-import ftplib
+from ftp_publish import FTPPool, FTPPublisher
+from manifest import Manifest
 import dropbox
 from datetime import datetime
+# PIL, rembg and onnxruntime are imported by process_folder() through timed_import(),
+# only once a folder actually needs processing.
+from run_metrics import metrics, process_age, timed_import
+IMPORTED = time.perf_counter()
 
 # === Dropbox Setup ===
 dbx = dropbox.Dropbox(
@@ -23,12 +27,21 @@ FTP_HOST = os.environ["FTP_HOST"]
 FTP_USER = os.environ["FTP_USER"]
 FTP_PASS = os.environ["FTP_PASS"]
 REMOTE_BASE_PATH = '/domains/ipwstock.com/public_html/public/dropbox/'
+# Published size/sha256 per remote file, so unchanged derivatives are not re-sent.
+manifest = Manifest(".manifest.sqlite")
+publisher = FTPPublisher(FTPPool(FTP_HOST, FTP_USER, FTP_PASS, size=1), manifest=manifest)
+
+# One keep-alive connection pool for every listing and download request.
+http = requests.Session()
+SET_UP = time.perf_counter()
 
 
 # ----------------------------
 # Helpers for Dropbox v12
 # ----------------------------
 def get_access_token(dbx: dropbox.Dropbox):
+    # The SDK only refreshes the short-lived token on its own calls; these requests bypass it.
+    dbx.check_and_refresh_access_token()
     return dbx._oauth2_access_token
 
 
@@ -40,7 +53,7 @@ def list_shared_link_files(shared_link_url):
 
     entries = []
     while True:
-        resp = requests.post(endpoint, headers=headers, json=payload)
+        resp = http.post(endpoint, headers=headers, json=payload)
         resp.raise_for_status()
         data = resp.json()
         entries.extend(data["entries"])
@@ -63,14 +76,14 @@ def download_shared_file(shared_link_url, file_metadata, local_dir):
     }
     endpoint = "https://content.dropboxapi.com/2/sharing/get_shared_link_file"
 
-    resp = requests.post(endpoint, headers=headers, stream=True)
-    resp.raise_for_status()
-
     os.makedirs(local_dir, exist_ok=True)
     local_path = os.path.join(local_dir, file_metadata["name"])
-    with open(local_path, "wb") as f:
-        for chunk in resp.iter_content(chunk_size=8192):
-            f.write(chunk)
+    with http.post(endpoint, headers=headers, stream=True) as resp:
+        resp.raise_for_status()
+        with open(local_path + ".part", "wb") as f:
+            for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+    os.replace(local_path + ".part", local_path)
 
     print(f"Downloaded: {local_path}")
     return local_path
@@ -91,183 +104,61 @@ def update_last_run_time():
         f.write(datetime.utcnow().isoformat())
 
 
+def has_changed(entry, last_run):
+    """
+    Decide from the listing alone whether a file needs processing: by
+    content_hash against what was last published (see manifest.py), or by
+    server_modified against the last run when Dropbox sends no hash.
+    """
+    content_hash = entry.get("content_hash")
+    if content_hash:
+        return not manifest.is_published(entry["path_lower"], content_hash)
+    server_modified = entry.get("server_modified")
+    if server_modified and last_run:
+        return datetime.fromisoformat(server_modified.rstrip("Z")) > last_run
+    return True
+
+
 # ----------------------------
 # Processing pipeline
 # ----------------------------
 def process_folder(base_folder, folder):
     folder_path = os.path.join(base_folder, folder)
 
-    # === STEP 1: Resize to 6000x4000 & white background ===
-    for file in os.listdir(folder_path):
-        image_path = os.path.join(folder_path, file)
-        if not os.path.isfile(image_path):
-            continue
-        try:
-            original_image = Image.open(image_path)
-        except:
-            continue
-
-        target_height, target_width = 4000, 6000
-        original_width, original_height = original_image.size
-        aspect_ratio = original_width / original_height
-
-        if aspect_ratio > target_width / target_height:
-            desired_width = target_width
-            desired_height = int(target_width / aspect_ratio)
-        else:
-            desired_height = target_height
-            desired_width = int(target_height * aspect_ratio)
-
-        resized_image = original_image.resize((desired_width, desired_height), Image.LANCZOS)
-        crop_left = (desired_width - target_width) // 2
-        crop_top = (desired_height - target_height) // 2
-        crop_right = crop_left + target_width
-        crop_bottom = crop_top + target_height
-        cropped_image = resized_image.crop((crop_left, crop_top, crop_right, crop_bottom))
-        background_image = Image.new('RGB', (target_width, target_height), (255, 255, 255))
-        paste_left = (target_width - cropped_image.width) // 2
-        paste_top = (target_height - cropped_image.height) // 2
-        background_image.paste(cropped_image, (paste_left, paste_top))
-        background_image.save(image_path)
-        print(f"{image_path} resized to 6000x4000 with white background.")
-
-    # === STEP 2: Remove background & convert to .webp ===
-    for file in os.listdir(folder_path):
-        file_path = os.path.join(folder_path, file)
-        if not os.path.isfile(file_path):
-            continue
-        try:
-            img = Image.open(file_path)
-        except:
-            continue
-        remove_bg = remove(img)
-        webp_path = file_path + '.webp'
-        remove_bg.save(webp_path, format="webp", optimize=True, quality=80)
-        print(f"{file} background removed & saved as webp.")
-
-    # === STEP 3: Clean up originals ===
-    for file in os.listdir(folder_path):
-        file_path = os.path.join(folder_path, file)
-        time.sleep(1)
-        if file.endswith('.webp'):
-            filename, extension = os.path.splitext(file_path)
-            new_file_path = filename.split(".")[0] + extension
-            os.rename(file_path, new_file_path)
-        elif file.lower().endswith(('.jpg', '.png')):
-            os.remove(file_path)
-            print(f"{file} removed.")
-
-    # === STEP 4: Create PNG folder & save 500x500 PNG ===
+    # === STEP 1-6: Build the main .webp, PNG and 400x270 images in memory ===
+    processed = timed_import("image_pipeline", "image stack import").build_derivatives(folder_path, folder)
     png_folder = os.path.join(folder_path, "PNG")
-    if not os.path.exists(png_folder):
-        os.mkdir(png_folder)
-    for file in os.listdir(folder_path):
-        if file not in ("PNG", "images") and file.lower().endswith('.webp'):
-            image_path = os.path.join(folder_path, file)
-            img = Image.open(image_path)
-            target_height, target_width = 500, 500
-            original_width, original_height = img.size
-            aspect_ratio = original_width / original_height
-            if aspect_ratio > target_width / target_height:
-                desired_width = target_width
-                desired_height = int(target_width / aspect_ratio)
-            else:
-                desired_height = target_height
-                desired_width = int(target_height * aspect_ratio)
-            resized_image = img.resize((desired_width, desired_height), Image.LANCZOS)
-            crop_left = (desired_width - target_width) // 2
-            crop_top = (desired_height - target_height) // 2
-            crop_right = crop_left + target_width
-            crop_bottom = crop_top + target_height
-            cropped_image = resized_image.crop((crop_left, crop_top, crop_right, crop_bottom))
-            background_image = Image.new('RGB', (target_width, target_height), (255, 255, 255))
-            paste_left = (target_width - cropped_image.width) // 2
-            paste_top = (target_height - cropped_image.height) // 2
-            background_image.paste(cropped_image, (paste_left, paste_top))
-            png_path = os.path.join(png_folder, folder + '.png')
-            background_image.save(png_path, format="png", optimize=True, quality=10)
-            print(f"{image_path} saved as 500x500 PNG.")
-
-    # === STEP 5: Create images folder & save 400x270 images ===
     images_folder = os.path.join(folder_path, "images")
-    if not os.path.exists(images_folder):
-        os.mkdir(images_folder)
-    for file in os.listdir(folder_path):
-        if file not in ("PNG", "images") and file.lower().endswith('.webp'):
-            image_path = os.path.join(folder_path, file)
-            img = Image.open(image_path)
-            resized_image = img.resize((400, 270), Image.LANCZOS)
-            save_path = os.path.join(images_folder, file)
-            resized_image.save(save_path)
-            print(f"{image_path} resized to 400x270 in images folder.")
-
-    # === STEP 6: Remove background again in /images & set white background ===
-    for file in os.listdir(images_folder):
-        if file.endswith('.webp'):
-            input_image_path = os.path.join(images_folder, file)
-            with open(input_image_path, "rb") as f:
-                image_data = f.read()
-            result = remove(image_data)
-            image = Image.open(io.BytesIO(result)).convert("RGBA")
-            background = Image.new('RGBA', image.size, (255, 255, 255, 255))
-            background.paste(image, (0, 0), image)
-            background.save(input_image_path, format="WEBP")
-            print(f"{input_image_path} white background reapplied.")
 
     # === STEP 7: Store Image to hostinger account ===
-    ftp = ftplib.FTP(FTP_HOST, FTP_USER, FTP_PASS)
-    ftp.cwd(REMOTE_BASE_PATH)
-
-    remote_folder_path = os.path.join(REMOTE_BASE_PATH, folder)
-    remote_folders = ftp.nlst()
-    if folder not in remote_folders:
-        ftp.mkd(remote_folder_path)
-        print(f"'{folder}' created on the remote server.")
-
-    def upload_folder(local_path, remote_path):
-        try:
-            ftp.mkd(remote_path)
-            print(f"Created remote directory: {remote_path}")
-        except ftplib.error_perm as e:
-            if not str(e).startswith("550"):
-                raise
-        for filename in os.listdir(local_path):
-            local_file = os.path.join(local_path, filename)
-            remote_file = f"{remote_path}/{filename}"
-            if os.path.isfile(local_file):
-                try:
-                    ftp.size(remote_file)
-                    print(f"'{remote_file}' already exists on the remote server.")
-                except ftplib.error_perm as e:
-                    if "550" in str(e):
-                        with open(local_file, 'rb') as f:
-                            ftp.storbinary(f"STOR {remote_file}", f)
-                        print(f"Uploaded: {remote_file}")
-                    else:
-                        print(f"Error checking '{remote_file}': {str(e)}")
-
-    # Upload main .webp
-    main_webp_list = [x for x in os.listdir(folder_path) if x.endswith('.webp')]
-    for webp_image in main_webp_list:
-        local_image_path = os.path.join(folder_path, webp_image)
-        server_path = f"{remote_folder_path}/{webp_image}"
-        try:
-            ftp.size(server_path)
-            print(f"'{server_path}' already exists on the remote server.")
-        except ftplib.error_perm as e:
-            if "550" in str(e):
-                with open(local_image_path, 'rb') as f:
-                    ftp.storbinary(f"STOR {server_path}", f)
-                print(f"'{server_path}' transferred to the remote server.")
-            else:
-                print(f"Error checking '{webp_image}': {str(e)}")
-
-    if os.path.exists(images_folder):
-        upload_folder(images_folder, f"{remote_folder_path}/images")
-    if os.path.exists(png_folder):
-        upload_folder(png_folder, f"{remote_folder_path}/PNG")
-
-    ftp.quit()
+    # One listing per remote directory; only files whose bytes changed are sent (see ftp_publish).
+    remote_folder_path = f"{REMOTE_BASE_PATH.rstrip('/')}/{folder}"
+    for created in publisher.ensure_dirs([remote_folder_path, f"{remote_folder_path}/images", f"{remote_folder_path}/PNG"]):
+        print(f"'{created}' created on the remote server.")
+
+    jobs = [
+        (os.path.join(folder_path, x), f"{remote_folder_path}/{x}")
+        for x in os.listdir(folder_path) if x.endswith('.webp')
+    ]
+    for local_path, remote_path in ((images_folder, f"{remote_folder_path}/images"), (png_folder, f"{remote_folder_path}/PNG")):
+        if os.path.exists(local_path):
+            jobs += [
+                (os.path.join(local_path, x), f"{remote_path}/{x}")
+                for x in os.listdir(local_path) if os.path.isfile(os.path.join(local_path, x)) and not x.endswith(".part")
+            ]
+
+    failed = 0
+    for local_file, remote_file, status, size, seconds, error in publisher.publish(jobs):
+        if status == "failed":
+            print(f"Error uploading '{remote_file}': {error}")
+            failed += 1
+        elif status == "unchanged":
+            print(f"'{remote_file}' already up to date on the remote server.")
+        else:
+            print(f"Uploaded: {remote_file}")
+    if failed:
+        raise RuntimeError(f"{failed} of {len(jobs)} upload(s) failed")
+    return processed
 
 # ----------------------------
 # Main
@@ -277,25 +168,51 @@ def main():
     local_downloads = "downloads"
     os.makedirs(local_downloads, exist_ok=True)
 
+    age = process_age()
+    if age is not None:
+        metrics.phase("interpreter", max(0.0, age - (time.perf_counter() - STARTED)))
+    metrics.phase("imports", IMPORTED - STARTED)
+    metrics.phase("setup", SET_UP - IMPORTED)
+    listing_started = time.perf_counter()
     # List all files from shared link
     entries = list_shared_link_files(SHARED_LINK)
-
-    for entry in entries:
-        if entry[".tag"] == "file":
+    metrics.phase("listing", time.perf_counter() - listing_started)
+
+    # Only new or changed originals are downloaded; unchanged ones are skipped on metadata alone.
+    # Non-images are never processed, so never published: left in, they would be downloaded every run.
+    files = [
+        entry for entry in entries
+        if entry[".tag"] == "file" and entry["name"].lower().endswith((".jpg", ".jpeg", ".png"))
+    ]
+    changed = [entry for entry in files if has_changed(entry, last_run)]
+    print(f"{len(changed)} of {len(files)} image(s) new or changed since they were last published.")
+
+    for entry in changed:
+        folder_name = os.path.splitext(entry["name"])[0]
+        try:
             local_file = download_shared_file(SHARED_LINK, entry, local_downloads)
-
-            if not last_run or os.path.getmtime(local_file) > last_run.timestamp():
-                folder_name = os.path.splitext(entry["name"])[0]
-                folder_path = os.path.join(local_downloads, folder_name)
-                os.makedirs(folder_path, exist_ok=True)
-                os.rename(local_file, os.path.join(folder_path, entry["name"]))
-
-                try:
-                    process_folder(local_downloads, folder_name)
-                except Exception as e:
-                    print(f"Error processing {folder_name}: {e}")
+            folder_path = os.path.join(local_downloads, folder_name)
+            os.makedirs(folder_path, exist_ok=True)
+            os.replace(local_file, os.path.join(folder_path, entry["name"]))
+            processed = process_folder(local_downloads, folder_name)
+        except Exception as e:
+            print(f"Error processing {folder_name}: {e}")
+            continue
+        # A source that failed to decode is not marked published, so the next run tries it again.
+        if entry["name"] in processed and entry.get("content_hash"):
+            manifest.mark_published([(entry["path_lower"], entry["content_hash"])])
 
     update_last_run_time()
+    if "image_pipeline" in sys.modules:
+        print(sys.modules["image_pipeline"].get_remover().summary())
+        print(sys.modules["image_pipeline"].get_budget().summary())
+    else:
+        print("Image stack never loaded: no folder needed processing.")
+    print(metrics.startup_table())
+    print(publisher.summary())
+    publisher.close()
+    manifest.close()
+    http.close()
 
 
 if __name__ == "__main__":
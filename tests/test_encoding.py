@@ -0,0 +1,70 @@
+from PIL import Image, ImageDraw, ImageFilter
+
+import encoding
+
+SIZE = (900, 600)
+
+
+def cutout(rgb):
+    """rgb with an elliptical alpha mask, like a segmented product shot."""
+    mask = Image.new("L", rgb.size, 0)
+    width, height = rgb.size
+    ImageDraw.Draw(mask).ellipse((width // 10, height // 10, width * 9 // 10, height * 9 // 10), fill=255)
+    image = rgb.convert("RGBA")
+    image.putalpha(mask)
+    return image
+
+
+def noisy_image():
+    channels = [
+        Image.effect_noise(SIZE, sigma).filter(ImageFilter.GaussianBlur(radius))
+        for sigma, radius in ((60, 1), (40, 0.6), (80, 1.5))
+    ]
+    return cutout(Image.merge("RGB", channels))
+
+
+def smooth_image():
+    channels = [
+        Image.linear_gradient("L").resize(SIZE),
+        Image.radial_gradient("L").resize(SIZE),
+        Image.linear_gradient("L").rotate(90).resize(SIZE),
+    ]
+    return cutout(Image.merge("RGB", channels))
+
+
+def encoded_sizes(image, profile):
+    """Size of the image's encode at every quality in the profile's range."""
+    return {q: len(encoding._encode_webp(image, profile, q)) for q in range(profile.min_quality, profile.max_quality + 1)}
+
+
+def check_against_exhaustive(monkeypatch, image):
+    # Search this small image the way the 24 MP main image is searched: from a reduced copy.
+    monkeypatch.setattr(encoding, "SEARCH_MAX_PIXELS", 60000)
+    profile = encoding.PROFILES["main"]
+    sizes = encoded_sizes(image, profile)
+    low, high = sizes[profile.min_quality], sizes[profile.max_quality]
+    for share in (0.1, 0.3, 0.5, 0.7, 0.9):
+        budgeted = profile._replace(max_bytes=int(low + share * (high - low)))
+        # Exhaustive: the highest quality whose encode fits. WebP sizes are not strictly monotonic
+        # in quality, so the search may settle a point or two below an isolated higher fit.
+        best = max(q for q, size in sizes.items() if size <= budgeted.max_bytes)
+        data, quality, within_budget = encoding.encode(image, budgeted)
+        assert within_budget and len(data) <= budgeted.max_bytes
+        assert best - 2 <= quality <= best, (share, quality, best)
+
+
+def test_main_search_matches_exhaustive_on_noisy_image(monkeypatch):
+    check_against_exhaustive(monkeypatch, noisy_image())
+
+
+def test_main_search_matches_exhaustive_on_smooth_image(monkeypatch):
+    check_against_exhaustive(monkeypatch, smooth_image())
+
+
+def test_main_search_takes_max_quality_when_it_fits(monkeypatch):
+    monkeypatch.setattr(encoding, "SEARCH_MAX_PIXELS", 60000)
+    image = smooth_image()
+    profile = encoding.PROFILES["main"]
+    roomy = profile._replace(max_bytes=max(encoded_sizes(image, profile).values()) * 2)
+    _, quality, within_budget = encoding.encode(image, roomy)
+    assert (quality, within_budget) == (profile.max_quality, True)
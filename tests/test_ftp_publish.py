@@ -0,0 +1,75 @@
+import ftplib
+
+import pytest
+
+import ftp_publish
+from ftp_publish import FTPPool
+
+
+class FakeFTP:
+    """Stands in for ftplib.FTP: a login that records whether it was closed."""
+
+    instances = []
+
+    def __init__(self, host, user, password, timeout=None):
+        self.closed = False
+        FakeFTP.instances.append(self)
+
+    def voidcmd(self, command):
+        return "200 OK"
+
+    def close(self):
+        self.closed = True
+
+    def quit(self):
+        self.closed = True
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    FakeFTP.instances = []
+    monkeypatch.setattr(ftp_publish.ftplib, "FTP", FakeFTP)
+    return FTPPool("host", "user", "password", size=2)
+
+
+def test_450_keeps_connection_in_pool(pool):
+    calls = []
+
+    def busy(ftp):
+        calls.append(ftp)
+        raise ftplib.error_temp("450 Requested file action not taken")
+
+    with pytest.raises(ftplib.error_temp):
+        pool.run(busy)
+
+    assert len(calls) == 1
+    assert pool.logins == 1
+    assert not FakeFTP.instances[0].closed
+    with pool.connection() as ftp:
+        assert ftp is FakeFTP.instances[0]
+
+
+def test_421_discards_connection_and_retries_once(pool):
+    calls = []
+
+    def dropped_once(ftp):
+        calls.append(ftp)
+        if len(calls) == 1:
+            raise ftplib.error_temp("421 Service not available, closing control connection")
+        return "sent"
+
+    assert pool.run(dropped_once) == "sent"
+    assert len(calls) == 2
+    assert pool.logins == 2
+    assert FakeFTP.instances[0].closed
+    assert calls[1] is FakeFTP.instances[1]
+
+
+def test_421_twice_is_raised(pool):
+    def dropped(ftp):
+        raise ftplib.error_temp("421 closing control connection")
+
+    with pytest.raises(ftplib.error_temp):
+        pool.run(dropped)
+    assert pool.logins == 2
+    assert all(ftp.closed for ftp in FakeFTP.instances)